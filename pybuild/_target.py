@@ -1,5 +1,6 @@
 import pathlib
 import os
+import itertools
 from collections import defaultdict
 try:
     import colorama
@@ -13,6 +14,12 @@ except:
         class Style:
             RESET_ALL = '\x1b[0m'
 import subprocess
+import shutil
+import json
+import concurrent.futures
+from .cache import JsonCache, stat_key
+from .digest import digests
+from .scan_deps import scan_p1689, scans, listings
 
 CXX = os.environ.get('CXX', 'clang++')
 LD = os.environ.get('LD', 'ld')
@@ -22,14 +29,42 @@ class glob:
         self.path = p
         self.glob = g
 
+procs = JsonCache("procs")
+
 class proc:
-    def __init__(self, *args):
+    """
+    A command whose output is split into args.
+    Each distinct command runs at most once per run. Pass a key to also keep
+    the output across runs until the key changes, e.g. the digest of a .pc file.
+    """
+    results = {}
+    def __init__(self, *args, key=None):
         self.args = args
+        self.key = key
+    @classmethod
+    def forget(cls):
+        """
+        Forget the output of every command without a key, so they run again
+        """
+        cls.results = {k: v for k, v in cls.results.items() if json.loads(k)[1] is not None}
+    def output(self):
+        k = json.dumps([self.args, self.key], default=str)
+        if (out := self.results.get(k)) is not None:
+            return out
+        if self.key is None or (out := procs.load().get(k)) is None:
+            p = subprocess.run(self.args, stdout = subprocess.PIPE, stdin = subprocess.PIPE)
+            out = [o.strip() for o in p.stdout.decode('utf-8').split() if o.strip()]
+            if self.key is not None:
+                procs[k] = out
+        self.results[k] = out
+        return out
 
 class func:
     def __init__(self, f):
         self.func = f
 
+pkg_flags = {}
+
 class pkg:
     def getCFlags(self, mode="debug"):
         return []
@@ -85,6 +120,57 @@ class target(dict):
     pymodules = []
 
     project = pathlib.Path(".")
+
+    # Any hashlib algorithm, used for all file and state digests
+    hash_algorithm = "sha256"
+
+    # Skip dependents of rebuilt targets whose output did not change.
+    # Can also be set per target with a "restat" key
+    restat = False
+
+    # Have cpp and cppm targets emit depfiles listing every header they read
+    depfiles = False
+
+    # Set to "clang-scan-deps" (or a path to it) to find module dependencies with
+    # clang-scan-deps -format=p1689 instead of the builtin line scanner.
+    # Sources are scanned with the compiler and flags of their target, unless
+    # scan_args is set to a command line to scan every source with
+    scanner = None
+    scan_args = None
+
+    # The mode being built, set before targets.py is loaded
+    mode = "debug"
+
+    # Precompile every `import <header>;` once as a header_unit target,
+    # instead of leaving it to -fimplicit-modules and the module cache
+    explicit_header_units = False
+
+    # Compile each cppm once with -fmodule-output=, producing its .pcm and a .o
+    # for linking, instead of precompiling and generating code from the .pcm later
+    module_objects = False
+    module_object_args = ["-c"]
+
+    # A directory to share command outputs through, across build dirs, modes and
+    # worktrees. Entries beyond artifact_cache_size bytes are evicted, least
+    # recently used first. Can also be disabled per target with "cache": False.
+    # .pcm files are only shared within one build dir, as they refer to the .pcm
+    # files they import by path. Add -fmodules-validate-input-files-content to
+    # precompile_args, so clang accepts them after a checkout touched the sources.
+    artifact_cache = os.environ.get("PYBUILD_ARTIFACT_CACHE")
+    artifact_cache_size = 10 << 30
+
+    # Admit jobs only while the sum of their peak RSS, declared with a "memory" key
+    # or measured in previous builds, fits in this many bytes. Defaults to the
+    # MemAvailable at the start of the build
+    memory_budget = None
+
+    # Named pools limiting how many of their jobs run at once, on top of -j.
+    # A target joins one with a "pool" key, e.g. pools = dict(link=2, install=1)
+    pools = {}
+
+    # Files read by targets.py, besides the python modules it imports and the
+    # sources it scans. pybuild --serve reloads targets.py once any of them changes
+    config_inputs = []
     
     _name = None
     @property
@@ -105,6 +191,14 @@ class target(dict):
         return self.get("virtual", False)
     @property
     def source(self):
+        # Command lines are hashed as they are expanded, so only function
+        # targets depend on the python code that defines them
+        if 'function' in self:
+            yield from self.pysource
+        yield from self.module_maps
+        yield from self.get("source", [])
+    @property
+    def pysource(self):
         yield __file__
         from . import build
         yield build.__file__
@@ -112,8 +206,16 @@ class target(dict):
         yield targets.__file__
         for m in self.pymodules:
             yield m.__file__
-        yield from self.module_maps
-        yield from self.get("source", [])
+    @property
+    def depfile(self):
+        return self.get("depfile", None)
+    @property
+    def pool(self):
+        return self.get("pool", None)
+    @property
+    def outputs(self):
+        # Files written besides the target itself and its depfile
+        return self.get("outputs", [])
     @property
     def deps(self):
         for i in self.get('deps', []):
@@ -121,7 +223,42 @@ class target(dict):
     @property
     def targets(self):
         return self.get("targets", [])
+    _expanded = None
     def getArgs(self, mode="debug"):
+        """
+        The expanded command line, memoized per mode for the rest of the run.
+        Lines using glob or func are only kept until expire_args, as what they
+        expand to can change once dependencies are built.
+        """
+        if self._expanded is None:
+            self._expanded = {}
+        if (args := self._expanded.get(mode)) is None:
+            args = self._expanded[mode] = list(self.expandArgs(mode))
+        return args
+    def expire_args(self, mode="debug"):
+        if not self._expanded or mode not in self._expanded:
+            return
+        raw = itertools.chain(self.common_args, self.modes[mode], self.get("args", []), self.get("cmd", []))
+        if any(isinstance(i, (glob, func)) for i in raw):
+            del self._expanded[mode]
+    def scan_flags(self, args=None):
+        """
+        The command line to scan this target's sources with: its compiler and
+        flags, leaving out the globs and funcs only known once the graph is built.
+        None without a scanner, so packages and procs are not forced for the builtin one.
+        """
+        if not self.scanner:
+            return None
+        if self.scan_args is not None:
+            return list(self.scan_args)
+        flags = []
+        for i in itertools.chain(self.common_args, self.modes[self.mode], self.get("args", []) if args is None else args):
+            if not isinstance(i, (glob, func)):
+                flags.extend(self.expand(i, self.mode))
+        if not flags or flags[0].startswith("-"):
+            flags.insert(0, CXX)
+        return flags
+    def expandArgs(self, mode="debug"):
         if 'function' in self:
             yield self['function']
             return
@@ -143,10 +280,13 @@ class target(dict):
             yield from self.expand(i, mode="cmd")
     def expand(self, i, mode="debug"):
         if isinstance(i, pkg):
-            for a in i.getCFlags(mode):
-                yield from self.expand(a, mode)
-            for a in i.getLDFlags(mode):
-                yield from self.expand(a, mode)
+            # keep i alive, so its id is not reused
+            if (flags := pkg_flags.get((id(i), mode))) is None:
+                flags = pkg_flags[(id(i), mode)] = (i, [
+                    *(f for a in i.getCFlags(mode) for f in self.expand(a, mode)),
+                    *(f for a in i.getLDFlags(mode) for f in self.expand(a, mode)),
+                ])
+            yield from flags[1]
         elif isinstance(i, glob):
             for p in pathlib.Path(i.path).glob(i.glob):
                 yield str(p)
@@ -156,11 +296,7 @@ class target(dict):
                     raise RuntimeError("Tried to get args from a faulty requirement function")
                 yield f
         elif isinstance(i, proc):
-            p = subprocess.run(i.args, stdout = subprocess.PIPE, stdin = subprocess.PIPE)
-            for o in p.stdout.decode('utf-8').split():
-                o = o.strip()
-                if o:
-                    yield o
+            yield from i.output()
         else:
             yield i
 
@@ -168,11 +304,28 @@ cppms = {}
 
 stubs = {}
 
-system_headers = set()
-local_headers = set()
+class HeaderSet(set):
+    """
+    Headers imported by the scanned sources, scanning any cpp targets still pending first
+    """
+    def __iter__(self):
+        scan_pending()
+        return super().__iter__()
+    def __len__(self):
+        scan_pending()
+        return super().__len__()
 
-def scan_file(f, module_name):
+system_headers = HeaderSet()
+local_headers = HeaderSet()
+
+def scan_lines(f):
+    """
+    Returns [module_name, deps, system_headers, local_headers] for one file
+    """
+    module_name = None
     deps = []
+    system = []
+    local = []
     
     for line in f.readlines():
         match line.strip().split():
@@ -181,12 +334,151 @@ def scan_file(f, module_name):
             case ("export", "import", n) | ("import", n):
                 match n.strip():
                     case header if n.startswith('<') and n.endswith('>;'):
-                        system_headers.add(header[1:-2])
+                        system.append(header[1:-2])
                     case header if n.startswith('"') and n.endswith('";'):
-                        local_headers.add(header[1:-2])
+                        local.append(header[1:-2])
                     case header:
                         deps.append(header[:-1])
-    return deps, module_name
+    return [module_name, deps, system, local]
+
+def scan_file(f, module_name):
+    name, deps, system, local = scan_lines(f)
+    system_headers.update(system)
+    local_headers.update(local)
+    return deps, name or module_name
+
+def scan_cached(pth):
+    """
+    scan_lines through the scan cache, so unchanged files are not read again
+    """
+    if (k := scans.key(pth, ["builtin"])) in scans:
+        return scans[k]
+    with open(pth, "r", encoding="utf-8") as f:
+        r = scan_lines(f)
+    if k is not None:
+        scans[k] = r
+    return r
+
+scan_results = {}
+# The command line each file in scan_results was scanned with
+scanned_with = {}
+
+def prescan(files):
+    """
+    Scan many files in one batch with target.scanner, files maps each path to the command line to scan it with.
+    Without a scanner, or if it is not installed, files are scanned one at a time as they are used.
+    """
+    if not target.scanner or not files:
+        return
+    if shutil.which(target.scanner) is None:
+        print(target.scanner, "not found, falling back to the builtin scanner")
+        target.scanner = None
+        return
+    scan_results.update(scan_p1689(files, target.scanner))
+
+def rescan(pth):
+    """
+    What scan would find in pth now, without recording it
+    """
+    if target.scanner:
+        args = scanned_with.get(pth) or target().scan_flags()
+        if (r := scan_p1689({pth: args}, target.scanner).get(pth)) is not None:
+            return r
+    return scan_cached(pth)
+
+def scan(pth, module_name, args):
+    pth = os.path.abspath(pth)
+    scanned_with[pth] = args
+    if pth not in scan_results:
+        prescan({pth: args})
+    if (r := scan_results.get(pth)) is None:
+        r = scan_results[pth] = scan_cached(pth)
+    name, deps, system, local = r
+    system_headers.update(system)
+    local_headers.update(local)
+    return list(deps), name or module_name, list(system)
+
+class ModuleGraph:
+    """
+    The transitive closure of the import graph in cppms, memoized per node,
+    so expanding -fmodule-file= lists is linear in the size of the graph.
+    Starts over whenever cppms grows.
+    """
+    def __init__(self):
+        self.closures = {}
+        self.size = 0
+
+    def closure(self, key, linking=False, path=()):
+        if self.size != len(cppms):
+            self.closures.clear()
+            self.size = len(cppms)
+        if (c := self.closures.get((key, linking))) is not None:
+            return c
+        if key in path:
+            cycle = [*path[path.index(key):], key]
+            raise RuntimeError(f"Module import cycle: {str.join(' -> ', cycle)}")
+        node = cppms[key]
+        c = set(node.own_pcms(linking))
+        for d in node.dep_modules():
+            c |= self.closure(d, linking, (*path, key))
+        c = self.closures[(key, linking)] = frozenset(c)
+        return c
+
+    def imports(self, keys, linking=False):
+        """
+        Everything needed to import all of keys
+        """
+        c = set()
+        for k in keys:
+            c |= self.closure(k, linking)
+        return c
+
+module_graph = ModuleGraph()
+
+header_units = {}
+
+class header_unit(target):
+    """
+    A system header imported with `import <header>;`, precompiled once to a header unit.
+    Importers depend on it like on a cppm, so all header units build in parallel.
+    Created for every imported system header when target.explicit_header_units is set,
+    and added to targets once targets.py is loaded. With target.depfiles, the headers
+    it read are hashed too, so a toolchain upgrade rebuilds it.
+    """
+    header_unit_args = ["-fmodule-header=system", "-xc++-system-header"]
+    def __init__(self, hdr, *args, **kw):
+        super().__init__(*args, **kw)
+        pcm = pathlib.Path(self.build) / "header_units" / f"{encode(hdr)}.pcm"
+        self.header = hdr
+        self.out = str(pcm)
+        self.update(
+            name=str(pcm),
+            out=str(pcm),
+            args=[*self.header_unit_args, hdr, "-o", str(pcm)]
+        )
+        if self.depfiles:
+            self['depfile'] = f"{pcm}.d"
+            self['args'] += ["-MD", "-MF", self['depfile']]
+        header_units[hdr] = self
+        cppms[str(pcm)] = self
+
+    @classmethod
+    def for_header(cls, hdr):
+        if (hu := header_units.get(hdr)) is None:
+            hu = cls(hdr)
+        return hu
+
+    def setup(self):
+        pathlib.Path(self.out).parent.mkdir(parents=True, exist_ok=True)
+
+    def own_pcms(self, linking=False):
+        yield f"-fmodule-file={self.out}"
+
+    def dep_modules(self):
+        return []
+
+    def get_dep_pcms(self, linking=False):
+        yield from self.own_pcms(linking)
 
 class cppm(target):
     """
@@ -203,8 +495,9 @@ class cppm(target):
 
         self.pcm_dir = pcm.parent
     
-        with pth.open("r", encoding="utf-8") as f:
-            deps, module_name = scan_file(f, str(pth))
+        deps, module_name, system = scan(pth, str(pth), self.scan_flags())
+        if self.explicit_header_units:
+            deps += [header_unit.for_header(hdr).out for hdr in system]
             
         self.update(
             dict(
@@ -213,6 +506,13 @@ class cppm(target):
             )
         )
         self.out = str(pcm)
+        self.obj = None
+
+        if self.module_objects:
+            self.obj = str(pcm.with_suffix('.o'))
+            compile_args = [*self.module_object_args, f"-fmodule-output={pcm}", "-o", self.obj]
+        else:
+            compile_args = [*self.precompile_args, "-o", str(pcm)]
 
         self.name = module_name
         self.pcm = target(
@@ -220,8 +520,13 @@ class cppm(target):
             source=[str(pth)],
             deps=deps,
             out=str(pcm),
-            args=[*self.precompile_args, "-o", str(pcm), str(pth), func(self.get_dep_args)]
+            args=[*compile_args, str(pth), func(self.get_dep_args)]
         )
+        if self.obj:
+            self.pcm['outputs'] = [self.obj]
+        if self.depfiles:
+            self.pcm['depfile'] = f"{pcm}.d"
+            self.pcm['args'] += ["-MD", "-MF", self.pcm['depfile']]
 
         if "stub" in str(pth).lower():
             stubs[module_name] = {
@@ -236,18 +541,20 @@ class cppm(target):
         if not self.pcm_dir.exists():
             self.pcm_dir.mkdir(parents=True)
 
-    def get_dep_pcms(self, linking=False):
+    def own_pcms(self, linking=False):
         yield f'''-fmodule-file={self.name}={str(self.pcm['out'])}'''
         if linking:
-            yield str(self.pcm['out'])
+            yield self.obj or str(self.pcm['out'])
+
+    def dep_modules(self):
+        return [d for d in self.pcm.deps if d in cppms]
+
+    def get_dep_pcms(self, linking=False):
+        yield from self.own_pcms(linking)
         yield from self.get_dep_args(linking)
         
     def get_dep_args(self, linking=False, mode="debug"):
-        deps = set()
-        for d in self.pcm.deps:
-            if d in cppms:
-                deps.update(cppms[d].get_dep_pcms(linking))
-        yield from sorted(deps)
+        yield from sorted(module_graph.imports(self.dep_modules(), linking))
     @classmethod
     def module(cls, path):
         for f in cppms.values():
@@ -255,26 +562,56 @@ class cppm(target):
                 return f.name
         raise KeyError(f"{path} not found in cppms")
 
+# cpp targets whose sources are not scanned yet
+unscanned = []
+
+def scan_pending():
+    """
+    Scan the sources of the cpp targets created since the last call, in one batch
+    """
+    if not unscanned:
+        return
+    todo = [(c, c.scan_flags(c.own_args)) for c in unscanned]
+    unscanned.clear()
+    prescan({c.path: flags for c, flags in todo if c.path not in scan_results})
+    for c, flags in todo:
+        c.scanned(flags)
+
 class cpp(target):
+    """
+    Scanned once its deps are first needed, so the sources of all cpp
+    targets created by then are scanned together
+    """
     def __init__(self, path, out, *args, **kw):
         super().__init__(*args, **kw)
         pth = pathlib.Path(self.project/path).expanduser()
 
         self.out = self.build / out
-    
-        with pth.open("r", encoding="utf-8") as f:
-            deps, _ = scan_file(f, None)
+        self.path = os.path.abspath(pth)
+        self.own_args = self.get('args', [])
+        unscanned.append(self)
 
-        self['deps'] = deps
+        self['deps'] = list(self.get('deps', []))
         self['source'] = [str(pth)]
         self['args'] = self.get('args', []) + ['-o', str(self.out), str(pth), func(self.get_deps)]
+        if self.depfiles:
+            self['depfile'] = f"{self.out}.d"
+            self['args'] += ["-MD", "-MF", self['depfile']]
+
+    def scanned(self, flags):
+        deps, _, system = scan(self.path, None, flags)
+        if self.explicit_header_units:
+            deps += [header_unit.for_header(hdr).out for hdr in system]
+        # Keep the deps given to cpp() or added since, and the list itself
+        self['deps'][:0] = [d for d in deps if d not in self['deps']]
+
+    @property
+    def deps(self):
+        scan_pending()
+        yield from self.get('deps', [])
 
     def get_deps(self, mode="debug"):
-        deps = set()
-        for d in self.deps:
-            if d in cppms:
-                deps.update(cppms[d].get_dep_pcms(linking=True))
-        return list(sorted(deps))
+        return list(sorted(module_graph.imports([d for d in self.deps if d in cppms], linking=True)))
                 
         
     def setup(self):
@@ -284,49 +621,83 @@ class cpp(target):
             
                         
 def find_cppms(*pths: [str | pathlib.Path]) -> None:
+    found = []
     for p in pths:
         pth = pathlib.Path(p).expanduser()
         if not pth.is_dir():
             pth = pth.parent
-        for tp, _, files in pth.walk():
+        for tp, _, files in listings.walk(pth):
             for f in files:
                 if f.endswith('.cppm'):
-                    cppm(tp/f)
+                    found.append(tp/f)
+    flags = target().scan_flags()
+    prescan({f: flags for f in found})
+    for f in found:
+        cppm(f)
     return cppms
 
 
-def check(hdr, system=True):
-    p = subprocess.Popen([CXX,
-                          '-x',
-                          'c++',
-                          '-std=c++26',
-                          '-stdlib=libc++',
-                          '-fimplicit-modules',
-                          '-fbuiltin-module-map',
-                          '-fimplicit-module-maps',
-                          '-',
-                          '-E',
-                          ],
-                         stdin = subprocess.PIPE,
-                         stdout = subprocess.PIPE,
-                         stderr = subprocess.PIPE)
+check_args = [
+    '-x',
+    'c++',
+    '-std=c++26',
+    '-stdlib=libc++',
+    '-fimplicit-modules',
+    '-fbuiltin-module-map',
+    '-fimplicit-module-maps',
+    '-',
+    '-E',
+]
+
+def import_line(hdr, system=True):
     if system:
         left = '<'
         right = '>'
     else:
         left = '"'
         right = '"'
-    p.stdin.write(f'import {left}{hdr}{right};\n'.encode('utf-8'))
+    return f'import {left}{hdr}{right};\n'.encode('utf-8')
+
+def check(hdr, system=True):
+    p = subprocess.Popen([CXX, *check_args],
+                         stdin = subprocess.PIPE,
+                         stdout = subprocess.PIPE,
+                         stderr = subprocess.PIPE)
+    p.stdin.write(import_line(hdr, system))
     p.stdin.close()
     return p
 
+def header_path(err):
+    err = err.decode('utf-8')
+    if '(aka ' in err:
+        return err.split('(aka ', 1)[1].split(') cannot', 1)[0]
+
 def wait_for_p(p):
     p.wait()
     
     if p.poll():
-        err = p.stderr.read().decode('utf-8')
-        if '(aka ' in err:
-            return err.split('(aka ', 1)[1].split(') cannot', 1)[0]
+        return header_path(p.stderr.read())
+
+def probe(hdr, system=True):
+    """
+    Ask the compiler where hdr lives. Blocks, so run it from a worker thread
+    """
+    p = subprocess.run([CXX, *check_args], input=import_line(hdr, system),
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if p.returncode:
+        return header_path(p.stderr)
+
+class HeaderCache(JsonCache):
+    """
+    Resolved header paths, keyed on the compiler binary, check_args and the header.
+    Headers the compiler could not resolve are not cached, so they are probed again next time.
+    """
+    def key(self, hdr, system=True):
+        self.load()
+        cxx = shutil.which(CXX) or CXX
+        return digests.hash(json.dumps([cxx, stat_key(cxx), check_args, system, hdr]).encode('utf-8'))
+
+headers = HeaderCache("headers")
 
 
 def encode(name):
@@ -334,24 +705,20 @@ def encode(name):
         
 def create_module_file(system = True):
     lines = target.module_lines[:]
-    hdrs = list(sorted(system_headers if system else local_headers))
-    print("checking", len(hdrs), "headers")
-    waiting = []
-    while hdrs:
-        for i in range(os.cpu_count()):
-            if hdrs:
-                f = hdrs.pop()
-                waiting.append((f, check(f)))
-            else:
-                break
-        for f, w in waiting:
-            p = wait_for_p(w)
+    keys = {hdr: headers.key(hdr, system) for hdr in sorted(system_headers if system else local_headers)}
+    todo = [hdr for hdr, k in keys.items() if k not in headers]
+    print("checking", len(todo), "of", len(keys), "headers")
+    with concurrent.futures.ThreadPoolExecutor(os.cpu_count()) as pool:
+        for hdr, p in zip(todo, pool.map(lambda hdr: probe(hdr, system), todo)):
             if p:
-                p = p.replace("'", '"')
-                lines.append(f"module {encode(f)} {{")
-                lines.append(f"    header {p}")
-                lines.append(f"    export *")
-                lines.append(f"}}")
+                headers[keys[hdr]] = p
+    for f, k in keys.items():
+        if p := headers.get(k):
+            p = p.replace("'", '"')
+            lines.append(f"module {encode(f)} {{")
+            lines.append(f"    header {p}")
+            lines.append(f"    export *")
+            lines.append(f"}}")
      
     return str.join('\n', lines)
             
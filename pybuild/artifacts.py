@@ -0,0 +1,153 @@
+import os
+import json
+import errno
+import fcntl
+import shutil
+import hashlib
+import pathlib
+
+# The FICLONE ioctl, _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+
+def reflink(src, dst):
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+class ArtifactCache:
+    """
+    A content addressed store of build outputs, shared by every build dir and mode.
+    Entries are keyed on the digests of a target's sources and its expanded
+    command line, and remember the digests of the inputs a depfile added, so
+    a header change is a miss. Each key keeps one variant per set of those
+    inputs, so switching back and forth between branches keeps hitting.
+    Files are placed by reflink, hardlink or copy, whichever works first.
+    The least recently used variants are evicted once the cache grows
+    beyond max_size.
+    """
+    methods = ("reflink", "hardlink", "copy")
+    def __init__(self, path, max_size):
+        self.path = pathlib.Path(path).expanduser()
+        self.max_size = max_size
+        self.hits = 0
+        self.stored = 0
+
+    def entry(self, key):
+        return self.path / key[:2] / key
+
+    def variants(self, key):
+        """
+        The variants stored for key, most recently used first
+        """
+        try:
+            found = [(v.stat().st_mtime, v) for v in self.entry(key).iterdir() if not v.name.endswith(".tmp")]
+        except OSError:
+            return []
+        return [v for _, v in sorted(found, reverse=True)]
+
+    def place(self, src, dst):
+        try:
+            os.unlink(dst)
+        except FileNotFoundError:
+            pass
+        for method in self.methods:
+            try:
+                if method == "reflink":
+                    reflink(src, dst)
+                elif method == "hardlink":
+                    os.link(src, dst)
+                else:
+                    shutil.copyfile(src, dst)
+                return
+            except OSError as e:
+                if method == "copy" or e.errno not in (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY,
+                                                       errno.EINVAL, errno.EPERM, errno.EMLINK):
+                    raise
+                try:
+                    os.unlink(dst)
+                except FileNotFoundError:
+                    pass
+
+    def detach(self, outputs):
+        """
+        Unlink outputs that are hardlinked into the cache, so a command that
+        writes them in place cannot corrupt the cached copy
+        """
+        for out in outputs:
+            try:
+                if os.stat(out).st_nlink > 1:
+                    os.unlink(out)
+            except OSError:
+                pass
+
+    def fetch(self, key, outputs, current):
+        """
+        Restore outputs from the entry for key, returns its recorded depfile
+        inputs, or None on a miss. current(path) is the digest of path now.
+        """
+        for entry in self.variants(key):
+            try:
+                with (entry / "manifest.json").open("r", encoding="utf-8") as f:
+                    manifest = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if len(manifest["outputs"]) != len(outputs):
+                continue
+            if all(current(path) == d for path, d in manifest["inputs"].items()):
+                break
+        else:
+            return None
+        try:
+            for i, out in enumerate(outputs):
+                pathlib.Path(out).parent.mkdir(parents=True, exist_ok=True)
+                self.place(entry / str(i), out)
+            os.utime(entry)
+        except OSError as e:
+            print("Could not restore", key, "from the artifact cache:", e)
+            return None
+        self.hits += 1
+        return manifest
+
+    def store(self, key, outputs, inputs):
+        variant = hashlib.sha256(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+        entry = self.entry(key) / variant
+        if entry.exists():
+            return
+        tmp = entry.with_name(f"{variant}.{os.getpid()}.tmp")
+        try:
+            tmp.mkdir(parents=True)
+            for i, out in enumerate(outputs):
+                self.place(out, tmp / str(i))
+            with (tmp / "manifest.json").open("w", encoding="utf-8") as f:
+                json.dump(dict(outputs=[str(o) for o in outputs], inputs=inputs), f)
+            os.rename(tmp, entry)
+            self.stored += 1
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def trim(self):
+        """
+        Evict least recently used entries until the cache fits max_size
+        """
+        if not self.stored:
+            return
+        entries = []
+        total = 0
+        for entry in self.path.glob("*/*/*"):
+            try:
+                size = sum(f.stat().st_size for f in entry.iterdir())
+                entries.append((entry.stat().st_mtime, size, entry))
+            except OSError:
+                continue
+            total += size
+        entries.sort()
+        for _, size, entry in entries:
+            if total <= self.max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+            try:
+                entry.parent.rmdir()
+            except OSError:
+                pass
@@ -1,15 +1,19 @@
-import json
 import sys
 import os
 import subprocess
 import pathlib
-import hashlib
 import time
 import enum
 import argparse
 import signal
 import itertools
 import shlex
+import selectors
+import heapq
+import re
+import traceback
+import concurrent.futures
+from collections import defaultdict
 verbose = False
 stop = False
 def SignalStop(num, frame):
@@ -30,18 +34,133 @@ signal.signal(signal.SIGUSR2, SignalStop)
 sys.dont_write_bytecode = True
 
 from ._target import *
+from .jobserver import Jobserver
+from .digest import digests
+from .cache import save_all, refresh
+from .status import StatusStore
+from .artifacts import ArtifactCache
+from .watch import Watcher
+from .scan_deps import listings
+from .library_search import settle
 
 
+# status.json is only read to migrate it into STATUS_DB
 STATUS_FILE = pathlib.Path("status.json")
+STATUS_DB = pathlib.Path("status.db")
 
-if STATUS_FILE.exists():
-    with STATUS_FILE.open("r", encoding="utf-8") as r:
-        meta_status = json.load(r)
-else:
-    meta_status = {}
+jobserver = None
+artifacts = None
+
+def parse_depfile(path):
+    """
+    Read the prerequisites out of a make style depfile, as written by -MD -MF
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        text = re.sub(r"\\\r?\n", " ", f.read())
+    deps = []
+    for line in text.splitlines():
+        parts = re.split(r"(?<!\\):(?:\s|$)", line, maxsplit=1)
+        if len(parts) < 2:
+            continue
+        for dep in re.findall(r"(?:\\.|[^\s\\])+", parts[1]):
+            deps.append(re.sub(r"\\([ #\\])", r"\1", dep).replace("$$", "$"))
+    return list(dict.fromkeys(deps))
+
+def relocate(s, build):
+    """
+    Replace the build dir in s, so artifact cache keys are shared between build dirs
+    """
+    return re.sub(rf"(?<![\w.-]){re.escape(build)}(?=/|$)", "@BUILD@", s)
 
 def system(args):
-    return subprocess.Popen(args, stdin=subprocess.PIPE)
+    pass_fds = jobserver.pass_fds if jobserver else ()
+    return subprocess.Popen(args, stdin=subprocess.PIPE, pass_fds=pass_fds)
+
+def reap(proc):
+    """
+    Like proc.poll(), but reaps processes with wait4, keeping their peak RSS in proc.maxrss
+    """
+    if isinstance(proc, Call) or proc.returncode is not None:
+        return proc.poll()
+    try:
+        pid, st, usage = os.wait4(proc.pid, os.WNOHANG)
+    except ChildProcessError:
+        return proc.poll()
+    if not pid:
+        return None
+    proc.returncode = os.waitstatus_to_exitcode(st)
+    # in KiB on Linux
+    proc.maxrss = usage.ru_maxrss * 1024
+    return proc.returncode
+
+def mem_available():
+    """
+    MemAvailable from /proc/meminfo in bytes, None where it is unknown
+    """
+    try:
+        with open("/proc/meminfo", "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+def parse_size(s):
+    """
+    A size in bytes, with an optional K, M, G or T suffix
+    """
+    units = dict(K=1 << 10, M=1 << 20, G=1 << 30, T=1 << 40)
+    s = s.strip().upper().removesuffix("B").removesuffix("I")
+    if s and s[-1] in units:
+        return int(float(s[:-1]) * units[s[-1]])
+    return int(s)
+
+class Call:
+    """
+    A function target running on Call.pool, in place of a process.
+    Provides the part of the Popen interface the scheduler uses, and its
+    fileno becomes readable once the function returned.
+    A running function cannot be interrupted, signals are ignored.
+    """
+    pool = None
+    def __init__(self, future):
+        self.returncode = None
+        self.returned = False
+        self.r, self.w = os.pipe()
+        self.future = future
+        future.add_done_callback(self.done)
+    def done(self, future):
+        os.write(self.w, b"x")
+        os.close(self.w)
+        self.returned = True
+    @classmethod
+    def submit(cls, fn, *args):
+        return cls(cls.pool.submit(fn, *args))
+    @classmethod
+    def finished(cls, result):
+        """
+        A call that already returned result
+        """
+        f = concurrent.futures.Future()
+        f.set_result(result)
+        return cls(f)
+    def fileno(self):
+        return self.r
+    def poll(self):
+        if self.returncode is None and self.returned:
+            try:
+                ok = self.future.result()
+            except Exception:
+                traceback.print_exc()
+                ok = False
+            self.returncode = 0 if ok else 1
+            os.close(self.r)
+        return self.returncode
+    def send_signal(self, num):
+        pass
+    def terminate(self):
+        pass
 
 class State(enum.Enum):
     default = 0
@@ -59,51 +178,79 @@ class Task:
     state = State.default
     globalState = State.default
     running = []
+    key = None
+    restored = False
+    cancelled = False
+    # Running jobs are admitted while the sum of their predicted peak RSS fits
+    # in memory_budget. Without an explicit budget, each job also has to fit in
+    # the current MemAvailable.
+    memory_budget = None
+    explicit_budget = False
+    memory_used = 0
+    rss = 0
+    # Running jobs per target.pools entry
+    pool_used = defaultdict(int)
     def markStarted(self):
         Task.building += 1
         Task.maxParallel = max(self.building, self.maxParallel)
+        self.rss = self.target.predicted_memory
+        Task.memory_used += self.rss
+        Task.pool_used[self.target.pool] += 1
         self.running.append(self)
     def markCompleted(self):
         Task.building -= 1
         Task.totalBuilt += 1
+        Task.memory_used -= self.rss
+        Task.pool_used[self.target.pool] -= 1
         self.running.remove(self)
+    def pool_free(self):
+        if (pool := self.target.pool) is None or (depth := target.pools[pool]) is None:
+            return True
+        return Task.pool_used[pool] < depth
+    def fits(self):
+        """
+        Whether this job fits in memory next to the running ones.
+        A job always fits if nothing else is running.
+        """
+        if not Task.running or Task.memory_budget is None:
+            return True
+        rss = self.target.predicted_memory
+        if not rss:
+            return True
+        if Task.memory_used + rss > Task.memory_budget:
+            return False
+        return Task.explicit_budget or rss <= (mem_available() or rss)
 
     def __init__(self, t):
         self.proc = None
         self.target = t
-    def poll(self):
-        if self.state is State.failure:
-            return 1
-        if self.state is State.rebuilt:
-            return 0
-        if self.proc is None:
-            if Task.globalState is State.failure:
-                return 1
-            if not self.maybeStart():
-                return None
-        r = self.proc.poll()
-        if r is not None:
-            old_state = self.state
-            if r:
-                print("Failure running",self)
-                print(str.join(' ', [repr(i) for i in self.args]))
-                self.state = State.failure
-                Task.globalState = State.failure
-                status[self.target.name] = None
-            else:
-                self.state = State.rebuilt
-                status[self.target.name] = self.target.finish_hash(self.source_sha)
-            if old_state is State.pending:
-                self.markCompleted()
+    def finish(self, r):
+        old_state = self.state
+        if r and self.cancelled:
+            print("cancelled:", self)
+            self.state = State.failure
+            status[self.target.name] = None
+        elif r:
+            print("Failure running",self)
+            print(str.join(' ', [repr(i) for i in self.args]))
+            self.state = State.failure
+            Task.globalState = State.failure
+            status[self.target.name] = None
         else:
-            if stop:
-                self.proc.send_signal(stop)
-        return r
-    def maybeStart(self):
-        if Task.building < Task.limit:
-            self.start()
-            return True
-        return False
+            self.state = State.rebuilt
+            if self.restored or self.target.read_depfile():
+                self.source_sha = self.target.hash_sources(self.known)
+            status[self.target.name] = self.target.finish_hash(self.source_sha)
+            if self.key and not self.restored:
+                self.target.store_artifacts(self.key)
+            self.target.changed = self.target.output_changed(self.output_before)
+            # A restore takes no time, the next miss still costs what the command did
+            if not self.restored:
+                timings[self.target.name] = round(time.monotonic() - self.started, 3)
+        if maxrss := getattr(self.proc, "maxrss", None):
+            memory[self.target.name] = maxrss
+        if old_state is State.pending:
+            self.markCompleted()
     def start(self):
         if self.globalState is State.failure:
             self.state = State.failure
@@ -112,27 +259,42 @@ class Task:
         if self.state is not State.default:
             print("Trying to start already started task", self)
             return False
-        self.source_sha = self.target.source_hash
+        # globs and funcs in the command line see what the dependencies built
+        self.target.expire_args()
+        self.known = self.target.source_digests()
+        self.source_sha = self.target.hash_sources(self.known)
+        self.output_before = self.target.target_hash
+        self.started = time.monotonic()
         self.markStarted()
         self.state = State.pending
-        if self.target.function:
-            if self.target.function(self.target):
-                args = ['true']
-            else:
-                args = ['false']
+        self.key = self.target.artifact_key()
+        self.restored = bool(self.key) and self.target.restore_artifacts(self.key)
+        if self.restored:
+            if verbose:
+                print("restored from the artifact cache:", self)
+            self.args = []
+            self.proc = Call.finished(True)
+        elif self.target.function:
+            fn = self.target.function
+            self.args = [getattr(fn, "__name__", repr(fn))]
+            self.proc = Call.submit(fn, self.target)
+        elif self.target.noop:
+            self.args = []
+            self.proc = Call.finished(True)
         else:
-            args = list(self.target.getArgs())
-        self.args = args
-        self.proc = system(args)
+            self.args = list(self.target.getArgs())
+            if self.key:
+                artifacts.detach(self.target.outputs)
+            self.proc = system(self.args)
         if self.target.name == "clean":
             status.clear()
         return True
-    def wait(self):
-        if self.proc is None:
-            if not self.start():
-                return
-        self.proc.wait()
-        return self.poll()
+    def cancel(self):
+        """
+        Stop a running task whose inputs changed under it
+        """
+        self.cancelled = True
+        self.proc.terminate()
     def __repr__(self):
         return f"<Task: {self.target}>"
     __str__=__repr__
@@ -146,6 +308,9 @@ class Target:
     state = State.default
     task = None
     mode = "debug"
+    dirty = True
+    changed = True
+    optional_deps = ()
     @staticmethod
     def __new__(cls, tname):
         t = cls.__used.get(tname, None)
@@ -155,6 +320,8 @@ class Target:
         cls.__used[tname] = t
         return t
     def __init__(self, tname):
+        if getattr(self, "name", None) == tname:
+            return
         t = targets[tname]
         if not isinstance(t, target):
             t = target(t)
@@ -167,6 +334,21 @@ class Target:
     def function(self):
         return self.__target.get('function', None)
     @property
+    def predicted_memory(self):
+        """
+        The peak RSS in bytes declared with a "memory" key, or measured in the last build
+        """
+        return self.__target.get("memory") or memory.get(self.name, 0)
+    @property
+    def pool(self):
+        return self.__target.pool
+    @property
+    def noop(self):
+        """
+        A virtual target without a command or function, it only groups its dependencies
+        """
+        return self.__target.virtual and not self.function and not list(self.__target.cmd)
+    @property
     def sha(self):
         if self.__target.virtual:
             return None
@@ -178,73 +360,47 @@ class Target:
             return th
         if th is None:
             return sh
-        return hashlib.sha256((self.source_hash + self.target_hash).encode('utf-8')).hexdigest()
+        return digests.hash((sh + th).encode('utf-8'))
     @property
     def target_hash(self):
         if self.__target.virtual:
             return None
-        p = pathlib.Path(self.name)
-        if p.exists():
-            with p.open('rb') as f:
-                return hashlib.sha256(f.read()).hexdigest()
+        return digests.digest(self.name)
     @property
     def source_hash(self):
+        return self.hash_sources(self.source_digests())
+    def source_digests(self):
+        """
+        The digests of the sources, the inputs discovered so far and the outputs
+        of the dependencies, as taken when a task starts
+        """
         if self.__target.virtual:
             return None
+        inputs = itertools.chain(self.__target.source, discovered.get(self.name, []), self.dependency_outputs())
+        return {s: digests.digest(s) for s in inputs}
+    def hash_sources(self, known):
+        """
+        The source hash from the digests in known, and the current digests of
+        inputs discovered since. Sources edited while a task ran are then still
+        seen as changed once it is done.
+        The outputs of dependencies are covered too, so a build that stopped
+        between a dependency and its dependent still rebuilds the dependent.
+        """
+        if known is None:
+            return None
         sha = b""
-        source = [pathlib.Path(i) for i in [*self.__target.source]]
-        for s in source:
-            if s.exists():
-                with s.open("rb") as f:
-                    sha = hashlib.sha256(sha + f.read()).hexdigest().encode('utf-8')
+        for s in itertools.chain(self.__target.source, discovered.get(self.name, [])):
+            if d := known[s] if s in known else digests.digest(s):
+                sha = digests.hash(sha + d.encode('utf-8')).encode('utf-8')
+        for o in sorted(set(self.dependency_outputs())):
+            d = o + ((known[o] if o in known else digests.digest(o)) or "")
+            sha = digests.hash(sha + d.encode('utf-8')).encode('utf-8')
         if not self.function:
             args = str.join(' ', self.getArgs()).encode('utf-8')
-            sha = hashlib.sha256(sha + args).hexdigest().encode('utf-8')
+            sha = digests.hash(sha + args).encode('utf-8')
         if h := self.__target.get('hash'):
-            sha = hashlib.sha256(sha + h.encode('utf-8')).hexdigest().encode('utf-8')
+            sha = digests.hash(sha + h.encode('utf-8')).encode('utf-8')
         return sha.decode('utf-8')
-    def poll(self):
-        if self.state is State.skipped or self.state is State.rebuilt:
-            return 0
-        if self.state is State.failure or self.state is State.missing:
-            return 1
-        waiting = False
-        for p in self.pending:
-            ec = p.poll()
-            if ec is None:
-                waiting = True
-            if ec:
-                self.state = State.failure
-                return ec
-        if waiting:
-            return None
-        if not self.task:
-            self.state = State.rebuilt
-            return 0
-        ec = self.task.poll()
-        if ec is not None:
-            if ec:
-                self.state = State.failure
-            else:
-                self.state = State.rebuilt
-        return ec
-    def wait(self):
-        if self.state is not State.pending:
-            return
-        for p in self.pending:
-            if self.poll():
-                self.state = State.failure
-                return
-            p.wait()
-        if self.poll():
-           self.state = State.failure
-           return
-        if self.task:
-            self.task.wait()
-            if self.task.poll():
-                self.state = State.failure
-            else:
-                self.state = State.rebuilt
     def prebuild(self, mode="debug"):
         if self.state is not State.default:
             return self
@@ -259,14 +415,16 @@ class Target:
                 print("Not building", self, "due to missing dep")
                 self.state = State.missing
                 return self
+        optionals = []
+        for r in self.__target.optionals:
+            optionals.extend(r(mode=mode))
+        self.optional_deps = optionals
         if self.__target.virtual:
             rebuild = bool(list(self.__target.cmd)) or bool(self.__target.get('function', None))
         else:
             rebuild = status.get(self.name, None) != self.sha
+        self.dirty = rebuild
         self.pending = []
-        optionals = []
-        for r in self.__target.optionals:
-            optionals.extend(r(mode=mode))
         for d in itertools.chain(optionals, self.__target.deps):
             dep = Target(d)
             dep.prebuild(mode)
@@ -292,10 +450,440 @@ class Target:
         return self
     def getArgs(self):
         return self.__target.getArgs(self.mode)
+    def expire_args(self):
+        self.__target.expire_args(self.mode)
+    @property
+    def restat(self):
+        return self.__target.get("restat", target.restat)
+    def needed(self):
+        """
+        Decided once everything this target waits on is done.
+        With restat, a target that was only pending because of its dependencies
+        is skipped if none of them actually changed their output.
+        """
+        if not self.restat or self.dirty:
+            return True
+        return any(p.changed for p in self.pending)
+    def output_changed(self, before):
+        if self.__target.virtual and not self.dirty:
+            return any(p.changed for p in self.pending)
+        after = self.target_hash
+        return before is None or after is None or before != after
+    def children(self):
+        for d in itertools.chain(self.__target.deps, self.__target.targets):
+            if d in targets:
+                yield Target(d)
+    def walk(self, seen):
+        if self in seen:
+            return
+        seen.add(self)
+        for c in self.children():
+            c.walk(seen)
+    def reset(self):
+        """
+        Forget the outcome of the last build, so the next prebuild decides again
+        """
+        self.state = State.default
+        self.task = None
+        self.dirty = True
+        self.changed = True
+    @property
+    def inputs(self):
+        if self.__target.virtual:
+            return
+        yield self.name
+        yield from self.__target.source
+        yield from discovered.get(self.name, [])
+    def read_depfile(self):
+        """
+        Record the inputs listed in this target's depfile, which are hashed
+        along with its sources from now on.
+        """
+        if not (path := self.__target.depfile):
+            return False
+        try:
+            discovered[self.name] = parse_depfile(path)
+        except OSError:
+            print("Missing depfile", path, "for", self)
+            discovered.pop(self.name, None)
+        return True
+    @property
+    def outputs(self):
+        yield self.name
+        yield from self.__target.outputs
+        if depfile := self.__target.depfile:
+            yield depfile
+    def artifact_key(self):
+        """
+        The artifact cache key of this target, None if it is not cached.
+        Covers the outputs of its dependencies, which its command may read
+        without listing them as sources.
+        Only the build dir is taken out of the command line, unless this
+        produces a .pcm, which names the .pcm files it imports.
+        """
+        if artifacts is None or self.__target.virtual or self.function or not self.__target.get("cache", True):
+            return None
+        build = str(target.build)
+        sha = b""
+        for s in self.__target.source:
+            d = digests.digest(s) or ""
+            sha = digests.hash(sha + d.encode('utf-8')).encode('utf-8')
+        for o in sorted(self.dependency_outputs()):
+            d = relocate(o, build) + (digests.digest(o) or "")
+            sha = digests.hash(sha + d.encode('utf-8')).encode('utf-8')
+        args = str.join(' ', self.getArgs())
+        if not any(o.endswith(".pcm") for o in self.outputs):
+            args = relocate(args, build)
+        sha = digests.hash(sha + args.encode('utf-8')).encode('utf-8')
+        if h := self.__target.get('hash'):
+            sha = digests.hash(sha + h.encode('utf-8')).encode('utf-8')
+        return sha.decode('utf-8')
+    def dependency_outputs(self, seen=None):
+        """
+        The files built by the dependencies of this target, looking through virtual ones
+        """
+        seen = set() if seen is None else seen
+        optionals = (Target(o) for o in self.optional_deps if o in targets)
+        for d in {*self.children(), *optionals}:
+            if d in seen:
+                continue
+            seen.add(d)
+            if d.__target.virtual:
+                yield from d.dependency_outputs(seen)
+            else:
+                yield d.name
+                yield from d.__target.outputs
+    def restore_artifacts(self, key):
+        build = str(target.build)
+        current = lambda path: digests.digest(path.replace("@BUILD@", build))
+        manifest = artifacts.fetch(key, list(self.outputs), current)
+        if manifest is None:
+            return False
+        if self.__target.depfile:
+            discovered[self.name] = [p.replace("@BUILD@", build) for p in manifest["inputs"]]
+        return True
+    def store_artifacts(self, key):
+        build = str(target.build)
+        inputs = {relocate(p, build): digests.digest(p) for p in discovered.get(self.name, [])}
+        artifacts.store(key, list(self.outputs), inputs)
+
+def save_caches():
+    """
+    Save every cache, once the package and license lookups still writing to them are done
+    """
+    settle()
+    save_all()
+
+def prefetch_digests(names):
+    """
+    Digest the sources and outputs of every target reachable from names in parallel
+    """
+    seen = set()
+    for n in names:
+        Target(n).walk(seen)
+    digests.prefetch(itertools.chain.from_iterable(t.inputs for t in seen))
+
+def watched_paths(roots):
+    """
+    The sources of every target reachable from roots, leaving out anything a target
+    writes, and the files and directories targets.py was loaded from
+    """
+    graph = set()
+    for r in roots:
+        r.walk(graph)
+    outputs = {os.path.abspath(o) for t in graph for o in t.outputs}
+    sources = {os.path.abspath(i) for t in graph for i in t.inputs} - outputs
+    from .daemon import target_inputs
+    config = {*target_inputs(target.project), *map(os.path.abspath, target.config_inputs)}
+    return sources | config, listings.listed, config
+
+def readers_of(graph, watcher, outputs):
+    """
+    The targets reading each input, including those their depfiles listed in the
+    last build, which are watched from now on unless a target writes them
+    """
+    readers = defaultdict(list)
+    for t in graph:
+        for i in t.inputs:
+            readers[os.path.abspath(i)].append(t)
+    watcher.add(readers.keys() - outputs)
+    return readers
+
+def run_phases(phases, mode, watcher=None):
+    """
+    Prebuild and run each list of roots in turn, so the setup roots are done
+    before the others are even prebuilt, and what they write is seen by them.
+    Returns the exit code and the paths that changed while building.
+    """
+    ec = 0
+    invalidated = set()
+    for roots in phases:
+        if not roots:
+            continue
+        scheduler = Scheduler([r.prebuild(mode) for r in roots], watcher)
+        ec |= scheduler.run()
+        invalidated |= scheduler.invalidated
+        if ec or invalidated or stop:
+            break
+    return ec, invalidated
+
+def watch(phases, mode, watcher, config, changed):
+    """
+    Build the roots in phases again whenever their sources change, until interrupted.
+    Only the targets reading a changed file and the targets depending on them
+    are prebuilt again, everything else stays skipped.
+    Returns None once targets.py has to be loaded again.
+    """
+    graph = set()
+    for r in itertools.chain.from_iterable(phases):
+        r.walk(graph)
+    parents = defaultdict(list)
+    for t in graph:
+        for c in t.children():
+            parents[c].append(t)
+    outputs = {os.path.abspath(o) for t in graph for o in t.outputs}
+    readers = readers_of(graph, watcher, outputs)
+    listed = {d: listings.modules(d) for d in listings.listed}
+    ec = 0
+    print("watching for changes")
+    while not stop:
+        changed |= watcher.wait(timeout=1)
+        if not changed:
+            continue
+        if changed & config:
+            return None
+        for d in changed & listed.keys():
+            if listings.modules(d) != listed[d]:
+                return None
+        for p in changed & scan_results.keys():
+            if rescan(p) != scan_results[p]:
+                return None
+        affected = set()
+        todo = [t for p in changed for t in readers.get(p, [])]
+        while todo:
+            if (t := todo.pop()) not in affected:
+                affected.add(t)
+                todo.extend(parents[t])
+        changed = set()
+        if not affected:
+            continue
+        for t in graph:
+            if t in affected or t.state is not State.skipped and t.state is not State.rebuilt and t.state is not State.missing:
+                t.reset()
+            elif t.state is State.rebuilt:
+                t.state = State.skipped
+        Task.globalState = State.default
+        Task.totalBuilt = 0
+        Task.maxParallel = 0
+        ec, changed = run_phases(phases, mode, watcher)
+        readers = readers_of(graph, watcher, outputs)
+        save_caches()
+        print(f"done building {Task.totalBuilt} jobs, using max", Task.maxParallel, "workers")
+        print("watching for changes")
+    return ec
+
+
+class Scheduler:
+    """
+    Runs the tasks of a prebuilt Target graph.
+    A target becomes ready as soon as every target it is waiting on has been
+    rebuilt, and ready targets are started until Task.limit jobs are running.
+    Children are reaped through pidfds as soon as they exit, function targets
+    run on Call.pool and are picked up as soon as they return.
+    Ready targets are started longest remaining path first, weighted by the
+    durations recorded in previous runs, skipping those whose pool is full or
+    whose predicted peak RSS does not fit in memory until running jobs finish.
+    With a jobserver, every job beyond the first also needs one of its tokens.
+    With a watcher, a change to a source stops new jobs from starting, and
+    cancels the running jobs reading it.
+    """
+    poll_interval = 0.05
+    def __init__(self, roots, watcher=None):
+        self.roots = roots
+        self.watcher = watcher
+        self.invalidated = set()
+        self.dependents = defaultdict(list)
+        self.blocked = {}
+        self.ready = []
+        self.leaves = []
+        self.weights = {}
+        self.counter = itertools.count()
+        self.default_estimate = sum(timings.values()) / len(timings) if timings else 1.0
+        self.signalled = False
+        self.starved = False
+        self.selector = selectors.DefaultSelector()
+        seen = set()
+        for r in roots:
+            self.collect(r, seen)
+    def collect(self, t, seen):
+        if t in seen:
+            return
+        seen.add(t)
+        if t.state is not State.pending:
+            return
+        if t.pool is not None and t.pool not in target.pools:
+            raise RuntimeError(f"{t.name} uses pool {t.pool}, which is not in target.pools")
+        for p in t.pending:
+            self.collect(p, seen)
+            self.dependents[p].append(t)
+        self.blocked[t] = len(t.pending)
+        if not t.pending:
+            self.leaves.append(t)
+    def estimate(self, t):
+        return timings.get(t.name, self.default_estimate)
+    def weight(self, t):
+        """
+        The predicted time from starting t until every root depending on it is done
+        """
+        if (w := self.weights.get(t)) is None:
+            w = self.estimate(t) + max((self.weight(d) for d in self.dependents[t]), default=0)
+            self.weights[t] = w
+        return w
+    def push(self, t):
+        heapq.heappush(self.ready, (-self.weight(t), next(self.counter), t))
+    def explain(self):
+        work = sum(self.estimate(t) for t in self.blocked)
+        print(f"{len(self.blocked)} jobs, {work:.2f}s of predicted work over {Task.limit} workers")
+        t = max(self.leaves, key=self.weight, default=None)
+        if t is None:
+            return
+        print(f"predicted critical path, {self.weight(t):.2f}s:")
+        while t is not None:
+            known = "" if t.name in timings else " (estimated)"
+            print(f"  {self.estimate(t):8.2f}s {self.weight(t):8.2f}s  {t.name}{known}")
+            t = max(self.dependents[t], key=self.weight, default=None)
+    def fill(self):
+        while self.ready and Task.building < Task.limit:
+            if stop or Task.globalState is State.failure or self.invalidated:
+                return
+            if (entry := self.pick()) is None:
+                return
+            t = entry[2]
+            if not t.needed():
+                self.skip(t)
+                continue
+            if jobserver and Task.building > len(jobserver.tokens):
+                if not jobserver.acquire():
+                    heapq.heappush(self.ready, entry)
+                    self.starved = True
+                    return
+            if not t.task.start():
+                self.fail(t)
+                continue
+            self.watch(t.task)
+    def pick(self):
+        """
+        Pop the heaviest ready target that has room in its pool and fits in memory,
+        None if none does. Targets that turn out not to be needed are returned too,
+        to be skipped.
+        """
+        held = []
+        found = None
+        while self.ready:
+            entry = heapq.heappop(self.ready)
+            if not entry[2].needed() or entry[2].task.pool_free() and entry[2].task.fits():
+                found = entry
+                break
+            held.append(entry)
+        for entry in held:
+            heapq.heappush(self.ready, entry)
+        return found
+    def release(self):
+        while jobserver and len(jobserver.tokens) > max(Task.building - 1, 0):
+            jobserver.release()
+    def watch(self, task):
+        task.pidfd = None
+        try:
+            if isinstance(task.proc, Call):
+                task.pidfd = os.dup(task.proc.fileno())
+            else:
+                task.pidfd = os.pidfd_open(task.proc.pid)
+        except (AttributeError, OSError):
+            return
+        self.selector.register(task.pidfd, selectors.EVENT_READ, task)
+    def unwatch(self, task):
+        if task.pidfd is not None:
+            self.selector.unregister(task.pidfd)
+            os.close(task.pidfd)
+            task.pidfd = None
+    def wait(self):
+        if stop and not self.signalled:
+            self.signalled = True
+            for task in Task.running:
+                task.proc.send_signal(stop)
+        timeout = self.poll_interval
+        if not stop and all(task.pidfd is not None for task in Task.running):
+            timeout = 1
+        if self.starved:
+            self.selector.register(jobserver.fileno(), selectors.EVENT_READ)
+        if self.watcher:
+            if self.watcher.fileno() is None:
+                timeout = min(timeout, self.watcher.poll_interval)
+            else:
+                self.selector.register(self.watcher.fileno(), selectors.EVENT_READ)
+        self.selector.select(timeout=timeout)
+        if self.starved:
+            self.selector.unregister(jobserver.fileno())
+            self.starved = False
+        if self.watcher:
+            if self.watcher.fileno() is not None:
+                self.selector.unregister(self.watcher.fileno())
+            self.invalidate(self.watcher.changes())
+        for task in list(Task.running):
+            r = reap(task.proc)
+            if r is None:
+                continue
+            self.unwatch(task)
+            task.finish(r)
+            self.release()
+            if r:
+                self.fail(task.target)
+            else:
+                self.done(task.target)
+    def invalidate(self, changed):
+        if not changed:
+            return
+        self.invalidated |= changed
+        for task in Task.running:
+            if not task.cancelled and any(os.path.abspath(i) in changed for i in task.target.inputs):
+                task.cancel()
+    def skip(self, t):
+        if verbose:
+            print("unchanged inputs, skipping:", t)
+        t.changed = False
+        t.state = State.skipped
+        self.release_dependents(t)
+    def done(self, t):
+        t.state = State.rebuilt
+        self.release_dependents(t)
+    def release_dependents(self, t):
+        for d in self.dependents[t]:
+            self.blocked[d] -= 1
+            if not self.blocked[d]:
+                self.push(d)
+    def fail(self, t):
+        if t.state is State.failure:
+            return
+        t.state = State.failure
+        for d in self.dependents[t]:
+            self.fail(d)
+    def run(self):
+        for t in self.leaves:
+            self.push(t)
+        while True:
+            self.fill()
+            if not Task.running:
+                break
+            self.wait()
+        self.selector.close()
+        ec = 0
+        for r in self.roots:
+            if r.state is not State.skipped and r.state is not State.rebuilt:
+                ec |= 1
+        return ec
 
         
-def main(argv = sys.argv):
-    global targets
+def parse_args(argv):
     global verbose
     if "-j" in argv:
         jidx = argv.index('-j')
@@ -312,7 +900,7 @@ def main(argv = sys.argv):
     argv = [(('--'+i) if '=' in i and not i.startswith('--') else i )for i in argv]
 
     parser = argparse.ArgumentParser(prog="pybuild", description="Run the pybuild build tool")
-    parser.add_argument("-j", "--jobs", type=int, nargs='?', default=1, const=os.cpu_count(),
+    parser.add_argument("-j", "--jobs", type=int, nargs='?', default=None, const=os.cpu_count(),
                         help="number of parallel jobs to use")
     parser.add_argument("--verbose", "-v", action="store_true",
                         help="enable verbose output")
@@ -325,16 +913,34 @@ def main(argv = sys.argv):
     parser.add_argument("-q", action="store_true", dest="quit", help="quit without building")
     parser.add_argument("--jobserver-auth", help=argparse.SUPPRESS)
     parser.add_argument("--use", help="set gentoo-style USE flags", default="")
+    parser.add_argument("--restat", action="store_true",
+                        help="skip dependents of targets whose output did not change")
+    parser.add_argument("--refresh-packages", action="store_true",
+                        help="ignore cached find_package results")
+    parser.add_argument("--explain-schedule", action="store_true",
+                        help="print the predicted critical path and quit without building")
+    parser.add_argument("--artifact-cache", type=pathlib.Path,
+                        help="share command outputs through this directory")
+    parser.add_argument("--memory-budget", type=parse_size,
+                        help="admit jobs while their predicted peak RSS fits in this many bytes (K, M, G suffixes)")
+    parser.add_argument("--serve", action="store_true",
+                        help="keep targets.py loaded and serve builds from pybuild/client.py")
+    parser.add_argument("--serve-fd", type=int, help=argparse.SUPPRESS)
 
     args, rest = parser.parse_known_intermixed_args(argv[1:])
     verbose = args.verbose
-    mode = args.mode
+    return args, rest
 
+def configure(args):
+    """
+    Apply the project wide options and load targets.py
+    """
+    global targets
+    mode = args.mode
     project = args.project
-    
-    Task.limit = args.jobs
 
     target.prefix = args.prefix
+    target.restat = target.restat or args.restat
 
     if target.build == args.build:
         target.build = target.build / mode
@@ -343,11 +949,28 @@ def main(argv = sys.argv):
     
     target.project = pathlib.Path(args.project)
 
+    if args.refresh_packages:
+        refresh.add("packages")
+
     target.use_flags.set((*shlex.split(os.environ.get('USE', '')), *shlex.split(args.use)))
 
+    target.mode = mode
     sys.path.insert(0, project)
     from targets import targets
     sys.path.pop(0)
+    scan_pending()
+    # Header units are created by the cpp and cppm targets importing them,
+    # so targets.py does not have to list them
+    for hu in header_units.values():
+        targets.setdefault(hu.name, hu)
+
+def run_build(args, rest):
+    """
+    Build the targets named in rest, with the targets loaded by configure
+    """
+    mode = args.mode
+    watching = "watch" in rest
+    rest = [r for r in rest if r != "watch"]
     if "targets" in rest or "tasks" in rest:
         a = targets["all"]
         print("The following top level targets are defined: \n\n")
@@ -378,47 +1001,88 @@ def main(argv = sys.argv):
     else:
         build_targets = [*setup, *rest]
 
-    global status
-    if (mstatus := meta_status.get(str(target.build), None)) is None:
-        meta_status[str(target.build)] = mstatus = {}
-        
-    if (status := mstatus.get(mode, None)) is None:
-        mstatus[mode] = status = {}
+    global jobserver
+    jobserver = Jobserver.from_makeflags(os.environ.get("MAKEFLAGS", ""), args.jobserver_auth)
+    if jobserver:
+        Task.limit = args.jobs or jobserver.jobs or os.cpu_count()
+    else:
+        Task.limit = args.jobs or 1
+        if Task.limit > 1:
+            jobserver = Jobserver.create(Task.limit)
+            os.environ["MAKEFLAGS"] = jobserver.makeflags
 
-    ec = 0
-    building = [Target(target).prebuild(mode) for target in build_targets]
-    if Task.limit > 1:
-        for i in range(30):
-            if stop:
-                break
-            finished = True
-            for b in building:
-                b.poll()
-                if b.state is State.pending:
-                    finished = False
-            if finished:
-                break
-            time.sleep(1)
-    for b in building:
-        b.wait()
-        ec |= b.poll()
+    global store, status, timings, discovered, memory
+    store = StatusStore(STATUS_DB)
+    store.migrate(STATUS_FILE)
+    status = store.table("status", target.build, mode)
+    timings = store.table("timings", target.build, mode)
+    memory = store.table("memory", target.build, mode)
+    discovered = store.table("discovered", target.build, mode)
+    settings = store.table("settings", target.build, mode)
 
-    for t in Task.running:
-        if t.proc:
-            t.wait()
+    digests.algorithm = target.hash_algorithm
+    if (old := settings.get("hash_algorithm", "sha256")) != digests.algorithm:
+        print(f"Hash algorithm changed from {old} to {digests.algorithm}, rebuilding everything")
+        status.clear()
+    settings["hash_algorithm"] = digests.algorithm
 
-    json_status = json.dumps(meta_status)
-    with STATUS_FILE.open("w", encoding="utf-8") as f:
-        print(json_status, file=f)
+    Task.memory_budget = args.memory_budget or target.memory_budget
+    Task.explicit_budget = Task.memory_budget is not None
+    if Task.memory_budget is None:
+        Task.memory_budget = mem_available()
 
-    print(f"done building {Task.totalBuilt} jobs, using max", Task.maxParallel, "workers")
+    global artifacts
+    if cache_dir := args.artifact_cache or target.artifact_cache:
+        artifacts = ArtifactCache(cache_dir, target.artifact_cache_size)
 
-    json_status = json.dumps(meta_status)
-    with STATUS_FILE.open("w", encoding="utf-8") as f:
-        print(json_status, file=f)
+    prefetch_digests(build_targets)
+    # setup runs before any other targets, which may read what it writes
+    phases = [[Target(t) for t in setup], [Target(t) for t in build_targets[len(setup):]]]
+    watcher = None
+    if watching:
+        files, dirs, config = watched_paths([r for roots in phases for r in roots])
+        watcher = Watcher(files, dirs)
+    Call.pool = concurrent.futures.ThreadPoolExecutor(Task.limit, thread_name_prefix="pybuild")
+    try:
+        if args.explain_schedule:
+            for roots in filter(None, phases):
+                Scheduler([r.prebuild(mode) for r in roots]).explain()
+            return 0
+        ec, invalidated = run_phases(phases, mode, watcher)
+        if watcher:
+            save_caches()
+            print(f"done building {Task.totalBuilt} jobs, using max", Task.maxParallel, "workers")
+            ec = watch(phases, mode, watcher, config, invalidated)
+    finally:
+        if jobserver:
+            jobserver.close()
+        if watcher:
+            watcher.close()
+        Call.pool.shutdown(cancel_futures=True)
+        store.close()
+
+    if watching and ec is None:
+        save_caches()
+        print("targets.py changed, restarting")
+        os.execv(sys.executable, [sys.executable, "-m", "pybuild", *sys.argv[1:]])
+
+    save_caches()
+    if artifacts:
+        artifacts.trim()
+        print(f"{artifacts.hits} jobs restored from the artifact cache")
+
+    print(f"done building {Task.totalBuilt} jobs, using max", Task.maxParallel, "workers")
 
     return ec
 
+def main(argv = sys.argv):
+    args, rest = parse_args(argv)
+    if args.serve:
+        from .daemon import serve
+        return serve(args)
+    configure(args)
+    return run_build(args, rest)
+
         
 if __name__ == "__main__":
     main()
@@ -0,0 +1,82 @@
+import os
+import json
+import pathlib
+
+CACHE_DIR = pathlib.Path(os.environ.get("PYBUILD_CACHE", ".pybuild"))
+
+caches = []
+
+# Names of caches to ignore on disk for this run. They are rebuilt from scratch and saved again
+refresh = set()
+
+def stat_key(path):
+    """
+    The stat signature of a file, or None if it does not exist.
+    A file whose signature is unchanged is assumed to have unchanged contents.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns]
+
+class JsonCache(dict):
+    """
+    A dict persisted to CACHE_DIR/<name>.json.
+    The file is only rewritten if something changed, and is replaced atomically.
+    A cache written with a different version is discarded.
+    """
+    version = 1
+    def __init__(self, name):
+        super().__init__()
+        self.name = name
+        self.path = CACHE_DIR / f"{name}.json"
+        self.dirty = False
+        self.loaded = False
+        self.signature = None
+        caches.append(self)
+
+    def load(self):
+        if self.loaded:
+            return self
+        self.loaded = True
+        if self.name in refresh:
+            self.dirty = True
+            return self
+        self.signature = stat_key(self.path)
+        try:
+            with self.path.open("r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return self
+        if data.get("version") == self.version:
+            self.update(data.get("entries", {}))
+        return self
+
+    def __setitem__(self, key, value):
+        self.dirty = True
+        super().__setitem__(key, value)
+
+    def save(self):
+        if not self.dirty:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        with tmp.open("w", encoding="utf-8") as f:
+            json.dump(dict(version=self.version, entries=self), f)
+        os.replace(tmp, self.path)
+        self.signature = stat_key(self.path)
+        self.dirty = False
+
+    def reload(self):
+        """
+        Load the file again if another process rewrote it since
+        """
+        if self.loaded and not self.dirty and stat_key(self.path) != self.signature:
+            self.clear()
+            self.loaded = False
+            self.load()
+
+def save_all():
+    for c in caches:
+        c.save()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Thin client for `python3 -m pybuild --serve`.
+Run it as a script, not through the pybuild package, so that no-op builds
+skip importing pybuild altogether:
+
+    alias pybuild="python3 /path/to/pybuild/client.py"
+
+Falls back to running python3 -m pybuild when nothing is serving this directory,
+when a parent make passed jobserver file descriptors, or to watch for changes.
+"""
+import os
+import re
+import sys
+import json
+import socket
+import signal
+
+# Same as pybuild.cache.CACHE_DIR / "daemon.sock", without importing pybuild
+SOCKET = os.path.join(os.environ.get("PYBUILD_CACHE", ".pybuild"), "daemon.sock")
+
+
+def local(argv):
+    path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [path, os.environ.get("PYTHONPATH")])))
+    os.execve(sys.executable, [sys.executable, "-m", "pybuild", *argv], env)
+
+
+def request(argv):
+    """
+    Build through the server, returns the exit code, or None if it restarted
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(SOCKET)
+        msg = json.dumps(dict(argv=argv, env=dict(os.environ))).encode('utf-8') + b"\n"
+        socket.send_fds(s, [msg], [0, 1, 2])
+        pid = None
+        def forward(num, frame):
+            if pid:
+                os.kill(pid, num)
+        signal.signal(signal.SIGINT, forward)
+        signal.signal(signal.SIGTERM, forward)
+        for line in s.makefile("r", encoding="utf-8"):
+            reply = json.loads(line)
+            if "pid" in reply:
+                pid = reply["pid"]
+            elif "exit" in reply:
+                return reply["exit"]
+            elif "restart" in reply:
+                return None
+    return 1
+
+
+def main(argv):
+    if "watch" not in argv and not re.search(r"--jobserver-(auth|fds)=[0-9]", os.environ.get("MAKEFLAGS", "")):
+        try:
+            for _ in range(3):
+                if (ec := request(argv)) is not None:
+                    return ec
+        except OSError:
+            pass
+    local(argv)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main(sys.argv[1:]))
@@ -0,0 +1,229 @@
+import os
+import sys
+import json
+import socket
+import traceback
+from . import build, _target
+from .cache import CACHE_DIR, caches, stat_key
+from .scan_deps import listings
+from .library_search import settle, packages
+
+SOCKET = CACHE_DIR / "daemon.sock"
+
+# Options and environment variables that take effect while targets.py is loaded.
+# A request differing in any of them restarts the server.
+config_args = ("mode", "build", "prefix", "project", "use", "restat", "refresh_packages")
+config_env = ("CXX", "LD", "USE", "PKG_CONFIG_PATH", "PYBUILD_CACHE", "PYBUILD_ARTIFACT_CACHE")
+
+
+def config_key(args, env):
+    return json.dumps([[str(getattr(args, a)) for a in config_args], [env.get(e) for e in config_env]])
+
+
+def listen():
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(SOCKET))
+    except OSError:
+        pass
+    else:
+        raise SystemExit(f"pybuild is already serving on {SOCKET}")
+    finally:
+        sock.close()
+    SOCKET.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        SOCKET.unlink()
+    except FileNotFoundError:
+        pass
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(str(SOCKET))
+    sock.listen()
+    return sock
+
+
+class Server:
+    """
+    Serves builds over a unix socket, with targets.py loaded once.
+    Each request is built in a forked child, so every build starts from the
+    loaded graph, scans and caches, and leaves them untouched for the next one.
+    The client passes its stdin, stdout and stderr along with the request.
+    Once a file targets.py depends on changes, or a request needs other
+    project wide options, the server re-executes itself and loads again.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self.key = None
+        self.inputs = {}
+        self.scanned = {}
+        self.listed = {}
+        self.std = [os.dup(fd) for fd in (0, 1, 2)]
+
+    def load(self, args):
+        build.configure(args)
+        # Builds run in forked children, which have no pool threads to finish lookups in
+        settle()
+        self.key = config_key(args, os.environ)
+        paths = set(target_inputs(args.project))
+        paths.update(map(os.path.abspath, _target.target.config_inputs))
+        paths.update(packages.files())
+        self.inputs = {p: stat_key(p) for p in paths}
+        # A build touches the project directory, so directories only count
+        # once what find_cppms reads of them changes
+        self.listed = {d: listings.modules(d) for d in listings.listed}
+        self.scanned = {p: stat_key(p) for p in _target.scan_results}
+        build.save_all()
+
+    def stale(self):
+        """
+        Whether targets.py has to be loaded again. Scanned sources only count
+        once their imports or module name change, not on every edit.
+        """
+        if any(stat_key(p) != sig for p, sig in self.inputs.items()):
+            return True
+        for d, listing in self.listed.items():
+            try:
+                if listings.modules(d) != listing:
+                    return True
+            except OSError:
+                return True
+        for p, sig in self.scanned.items():
+            if (now := stat_key(p)) != sig:
+                if _target.rescan(p) != _target.scan_results[p]:
+                    return True
+                self.scanned[p] = now
+        return False
+
+    def restart(self, argv, env):
+        """
+        Start over with the options of argv, keeping the listening socket
+        """
+        print("reloading targets.py")
+        env = {k: v for k, v in os.environ.items() if k not in config_env} | {
+            k: v for k, v in env.items() if k in config_env}
+        os.set_inheritable(self.sock.fileno(), True)
+        os.execve(sys.executable, [sys.executable, "-m", "pybuild", *argv, "--serve", f"--serve-fd={self.sock.fileno()}"], env)
+
+    def redirect(self, fds):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for fd, to in zip((0, 1, 2), fds):
+            os.dup2(to, fd)
+
+    def reply(self, conn, **msg):
+        try:
+            conn.sendall(json.dumps(msg).encode('utf-8') + b"\n")
+        except OSError:
+            pass
+
+    def receive(self, conn):
+        """
+        Read a request, a line of json sent along with the client's standard fds
+        """
+        msg, fds, _, _ = socket.recv_fds(conn, 1 << 16, 3)
+        for fd in fds:
+            os.set_inheritable(fd, False)
+        while msg and not msg.endswith(b"\n"):
+            if not (more := conn.recv(1 << 16)):
+                break
+            msg += more
+        try:
+            msg = json.loads(msg)
+        except ValueError:
+            msg = None
+        if msg is None or len(fds) != 3:
+            for fd in fds:
+                os.close(fd)
+            return None, ()
+        return msg, fds
+
+    def handle(self, conn):
+        msg, fds = self.receive(conn)
+        if msg is None:
+            return
+        try:
+            self.redirect(fds)
+            try:
+                args, rest = build.parse_args(["pybuild", *msg["argv"]])
+            except SystemExit as e:
+                return self.reply(conn, exit=e.code or 0)
+            if config_key(args, msg["env"]) != self.key or self.stale():
+                self.reply(conn, restart=True)
+                conn.close()
+                self.redirect(self.std)
+                self.restart(msg["argv"], msg["env"])
+            self.run(conn, args, rest, msg["env"])
+        finally:
+            self.redirect(self.std)
+            for fd in fds:
+                os.close(fd)
+            for c in caches:
+                c.reload()
+
+    def run(self, conn, args, rest, env):
+        pid = os.fork()
+        if pid:
+            self.reply(conn, pid=pid)
+            os.waitpid(pid, 0)
+            return
+        ec = 1
+        try:
+            self.sock.close()
+            os.environ.clear()
+            os.environ.update(env)
+            # Expanding args while loading must not fix them for every build
+            _target.proc.forget()
+            _target.pkg_flags.clear()
+            ec = build.run_build(args, rest)
+        except SystemExit as e:
+            ec = e.code if isinstance(e.code, int) else 1
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            self.reply(conn, exit=ec)
+            os._exit(ec)
+
+    def serve(self):
+        self.sock.settimeout(1)
+        print("serving on", SOCKET)
+        while not build.stop:
+            try:
+                conn, _ = self.sock.accept()
+            except TimeoutError:
+                continue
+            except InterruptedError:
+                continue
+            with conn:
+                conn.settimeout(None)
+                try:
+                    self.handle(conn)
+                except Exception:
+                    traceback.print_exc()
+
+
+def target_inputs(project):
+    """
+    The files of every loaded python module from the project or pybuild itself
+    """
+    roots = [os.path.abspath(project) + os.sep, os.path.dirname(os.path.abspath(__file__)) + os.sep]
+    for m in list(sys.modules.values()):
+        f = getattr(m, "__file__", None)
+        if f and os.path.abspath(f).startswith(tuple(roots)):
+            yield os.path.abspath(f)
+
+
+def serve(args):
+    if args.serve_fd is not None:
+        sock = socket.socket(fileno=args.serve_fd)
+        os.set_inheritable(sock.fileno(), False)
+    else:
+        sock = listen()
+    server = Server(sock)
+    server.load(args)
+    try:
+        server.serve()
+    finally:
+        sock.close()
+        SOCKET.unlink(missing_ok=True)
+    return 0
@@ -0,0 +1,73 @@
+import os
+import mmap
+import hashlib
+import concurrent.futures
+from .cache import JsonCache, stat_key
+
+class DigestCache(JsonCache):
+    """
+    Digests of files, keyed on their path and stat signature.
+    A file is only read again once its inode, size, mtime or ctime change,
+    or once the project switches to a different algorithm.
+    """
+    version = 2
+    algorithm = "sha256"
+    mmap_threshold = 64 << 20
+    workers = os.cpu_count()
+
+    def hash(self, data):
+        return hashlib.new(self.algorithm, data).hexdigest()
+
+    def compute(self, path):
+        """
+        Digest one file without holding it in memory. hashlib releases the GIL
+        while digesting, so this is safe to run from several threads.
+        """
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size < self.mmap_threshold:
+                return hashlib.file_digest(f, self.algorithm).hexdigest()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return hashlib.new(self.algorithm, mm).hexdigest()
+
+    def try_compute(self, path):
+        try:
+            return self.compute(path)
+        except OSError:
+            return None
+
+    def lookup(self, path):
+        if (sig := stat_key(path)) is None:
+            return None, None
+        if (entry := self.get(path)) and entry[0] == sig and entry[1] == self.algorithm:
+            return sig, entry[2]
+        return sig, None
+
+    def digest(self, path):
+        self.load()
+        path = os.path.abspath(path)
+        sig, d = self.lookup(path)
+        if sig is None or d is not None:
+            return d
+        d = self.compute(path)
+        self[path] = [sig, self.algorithm, d]
+        return d
+
+    def prefetch(self, paths):
+        """
+        Digest every stale file in paths through a thread pool,
+        so later digest calls are served from the cache.
+        """
+        self.load()
+        stale = {}
+        for path in {os.path.abspath(p) for p in paths}:
+            sig, d = self.lookup(path)
+            if sig is not None and d is None and os.path.isfile(path):
+                stale[path] = sig
+        if len(stale) < 2:
+            return
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+            for (path, sig), d in zip(stale.items(), pool.map(self.try_compute, stale)):
+                if d is not None:
+                    self[path] = [sig, self.algorithm, d]
+
+digests = DigestCache("digests")
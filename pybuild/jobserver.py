@@ -0,0 +1,116 @@
+import os
+import re
+import select
+import shlex
+import tempfile
+import pathlib
+
+
+class Jobserver:
+    """
+    A GNU make compatible jobserver.
+    Every job beyond the first needs a token read from the jobserver pipe, and the
+    token is written back once the job is done. Both the fifo style of make 4.4
+    and the older inherited pipe style are understood.
+    """
+    style = "pipe"
+    def __init__(self, auth, rfd, wfd, jobs=None, path=None, pass_fds=()):
+        self.auth = auth
+        self.rfd = rfd
+        self.wfd = wfd
+        self.jobs = jobs
+        self.path = path
+        self.pass_fds = pass_fds
+        self.tokens = []
+
+    @classmethod
+    def from_makeflags(cls, makeflags, auth=None):
+        """
+        Join the jobserver of a parent make, if there is one.
+        auth overrides the --jobserver-auth found in makeflags.
+        """
+        jobs = None
+        for flag in shlex.split(makeflags):
+            if m := re.fullmatch(r"-j([0-9]+)", flag):
+                jobs = int(m.group(1))
+            elif m := re.fullmatch(r"--jobserver-(?:auth|fds)=(.*)", flag):
+                auth = auth or m.group(1)
+        if not auth:
+            return None
+        if auth.startswith("fifo:"):
+            path = auth[5:]
+            try:
+                rfd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+                wfd = os.open(path, os.O_WRONLY)
+            except OSError as e:
+                print("jobserver unavailable:", e)
+                return None
+            return cls(f"fifo:{path}", rfd, wfd, jobs)
+        try:
+            r, w = (int(i) for i in auth.split(","))
+            os.fstat(r)
+            os.fstat(w)
+        except (ValueError, OSError):
+            print("jobserver unavailable: using -j1. Add '+' to the parent make rule.")
+            return None
+        try:
+            # A fresh open file description can be made non-blocking without affecting make
+            rfd = os.open(f"/proc/self/fd/{r}", os.O_RDONLY | os.O_NONBLOCK)
+        except OSError:
+            rfd = r
+        return cls(f"{r},{w}", rfd, w, jobs, pass_fds=(r, w))
+
+    @classmethod
+    def create(cls, jobs, style=None):
+        """
+        Start a jobserver for jobs parallel jobs. We hold the implicit token ourselves.
+        """
+        style = style or cls.style
+        if style == "fifo":
+            path = pathlib.Path(tempfile.mkdtemp(prefix="pybuild-")) / "jobserver"
+            os.mkfifo(path, 0o600)
+            rfd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+            wfd = os.open(path, os.O_WRONLY)
+            js = cls(f"fifo:{path}", rfd, wfd, jobs, path=path)
+        else:
+            r, w = os.pipe()
+            os.set_inheritable(r, True)
+            os.set_inheritable(w, True)
+            rfd = os.open(f"/proc/self/fd/{r}", os.O_RDONLY | os.O_NONBLOCK)
+            js = cls(f"{r},{w}", rfd, w, jobs, pass_fds=(r, w))
+        os.write(js.wfd, b"+" * (jobs - 1))
+        return js
+
+    @property
+    def makeflags(self):
+        return f" -j{self.jobs} --jobserver-auth={self.auth}"
+
+    def fileno(self):
+        return self.rfd
+
+    def acquire(self):
+        """
+        Try to take a token without blocking, returns True on success.
+        """
+        if self.rfd in self.pass_fds and not select.select([self.rfd], [], [], 0)[0]:
+            return False
+        try:
+            token = os.read(self.rfd, 1)
+        except BlockingIOError:
+            return False
+        if not token:
+            return False
+        self.tokens.append(token)
+        return True
+
+    def release(self):
+        os.write(self.wfd, self.tokens.pop())
+
+    def close(self):
+        while self.tokens:
+            self.release()
+        for fd in {self.rfd, self.wfd}.difference(self.pass_fds):
+            os.close(fd)
+        if self.path:
+            self.path.unlink()
+            self.path.parent.rmdir()
@@ -1,16 +1,46 @@
 from ._target import colorama, target, CXX, LD, pkg
+from .cache import JsonCache, stat_key
+from .digest import digests
+import os
+import json
 import subprocess
 import enum
 import shlex
 import pathlib
 import dataclasses
 import mmap
-import threading
+import shutil
 import re
 import itertools
+import concurrent.futures
+import struct
 
 libs = {}
 
+def start_pools():
+    """
+    Separate pools, so packages waiting on their libraries can never starve them.
+    A forked child starts its own, as it has none of the parent's threads.
+    """
+    global package_pool, library_pool, license_pool
+    package_pool = concurrent.futures.ThreadPoolExecutor(os.cpu_count(), thread_name_prefix="find_package")
+    library_pool = concurrent.futures.ThreadPoolExecutor(os.cpu_count(), thread_name_prefix="library")
+    license_pool = concurrent.futures.ThreadPoolExecutor(os.cpu_count(), thread_name_prefix="license")
+
+start_pools()
+os.register_at_fork(after_in_child=start_pools)
+
+# Package and license lookups still running in the pools
+lookups = []
+
+def settle():
+    """
+    Wait for every package and license lookup started so far, including
+    those started by lookups that were waited for
+    """
+    while lookups:
+        concurrent.futures.wait([lookups.pop()])
+
 try:
     subprocess.Popen("pkgconf", stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     pkgconf = "pkgconf"
@@ -69,11 +99,144 @@ class LS:
 static = LS(name="static")
 shared = LS(name="shared")
 
+def dump_ls(ls):
+    if ls is None:
+        return None
+    return [i.name for i in ls]
+
+def load_ls(names):
+    if names is None:
+        return None
+    lss = [{"static": static, "shared": shared}[n] for n in names]
+    if len(lss) == 1:
+        return lss[0]
+    return LS(*lss)
+
+def dump_ls_map(link_mode_map):
+    if link_mode_map is None:
+        return None
+    return {k: dump_ls(v) for k, v in link_mode_map.items()}
+
+def load_ls_map(link_mode_map):
+    if link_mode_map is None:
+        return None
+    return {k: load_ls(v) for k, v in link_mode_map.items()}
+
 class ABIS(enum.Enum):
     libcxx = 1
     libstdcpp = 2
     C = 3
 
+def abi_of(data):
+    """
+    Guess the C++ ABI from mangled names in data. A libc++ name is decisive,
+    since the original check preferred libc++ whenever both appear.
+    """
+    libstdcpp = False
+    for m in re.finditer(rb"__(cxx)?11", data):
+        if not m.group(1):
+            return ABIS.libcxx
+        libstdcpp = True
+    return ABIS.libstdcpp if libstdcpp else ABIS.C
+
+def elf_tables(mm, base=0, limit=None):
+    """
+    The string tables of the ELF file at base in mm, None if it is not one
+    """
+    limit = len(mm) if limit is None else limit
+    if mm[base:base + 4] != b"\x7fELF" or limit - base < 64:
+        return None
+    end = "<" if mm[base + 5] == 1 else ">"
+    if mm[base + 4] == 2:
+        shoff, = struct.unpack_from(end + "Q", mm, base + 0x28)
+        shentsize, shnum = struct.unpack_from(end + "HH", mm, base + 0x3A)
+        sh = end + "IIQQQQ"
+    else:
+        shoff, = struct.unpack_from(end + "I", mm, base + 0x20)
+        shentsize, shnum = struct.unpack_from(end + "HH", mm, base + 0x2E)
+        sh = end + "IIIIII"
+    tables = []
+    for i in range(shnum):
+        if base + shoff + (i + 1) * shentsize > limit:
+            return None
+        _, sh_type, _, _, offset, size = struct.unpack_from(sh, mm, base + shoff + i * shentsize)
+        if sh_type == 3: # SHT_STRTAB
+            tables.append(memoryview(mm)[base + offset:min(base + offset + size, limit)])
+    return tables
+
+def symbol_names(mm):
+    """
+    The parts of a mapped library that hold symbol names: the string tables of an
+    ELF file, or of every ELF member of an archive. The symbol index of an archive
+    only names what it defines, so it is used only when the members cannot be read,
+    as in a thin archive. None if neither can be found.
+    """
+    if mm[:8] in (b"!<arch>\n", b"!<thin>\n") and len(mm) >= 68:
+        thin = mm[:8] == b"!<thin>\n"
+        tables = []
+        armap = None
+        pos = 8
+        while pos + 60 <= len(mm):
+            name = mm[pos:pos + 16]
+            size = int(mm[pos + 48:pos + 58].split()[0])
+            data = pos + 60
+            if name.startswith(b"/ ") or name.startswith(b"/SYM64/"):
+                armap = memoryview(mm)[data:data + size]
+            elif not thin and not name.startswith(b"// "):
+                tables.extend(elf_tables(mm, data, min(data + size, len(mm))) or ())
+            if thin and not name.startswith((b"/ ", b"/SYM64/", b"// ")):
+                size = 0
+            pos = data + size + (size & 1)
+        if tables:
+            if armap is not None:
+                armap.release()
+            return tables
+        return [armap] if armap is not None else None
+    return elf_tables(mm) or None
+
+class AbiCache(JsonCache):
+    """
+    ABI verdicts per library, keyed on its path and stat signature
+    """
+    version = 2
+    def abi(self, lib_path):
+        key = str(lib_path)
+        sig = stat_key(key)
+        if (entry := self.load().get(key)) and entry[0] == sig:
+            return ABIS[entry[1]]
+        abi = self.scan(key)
+        self[key] = [sig, abi.name]
+        return abi
+
+    @staticmethod
+    def scan(lib_path):
+        """
+        Look only at the symbol names where possible, and never read the whole
+        file into memory: everything is scanned through an mmap.
+        """
+        with open(lib_path, 'rb') as lib:
+            try:
+                mm = mmap.mmap(lib.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                return ABIS.C
+            with mm:
+                try:
+                    tables = symbol_names(mm)
+                except (struct.error, ValueError, IndexError):
+                    tables = None
+                try:
+                    if tables is None:
+                        return abi_of(mm)
+                    verdicts = {abi_of(t) for t in tables}
+                    for abi in ABIS:
+                        if abi in verdicts:
+                            return abi
+                finally:
+                    for t in tables or []:
+                        t.release()
+
+abis = AbiCache("abis")
+
 @dataclasses.dataclass(init=False)
 class Library(pkg):
     found: bool
@@ -116,6 +279,7 @@ class Library(pkg):
                 self.ldflags = [*Libs, *ld_flags]
                 self.abi = abi
                 self.link_mode = shared if library.endswith(".so") else static
+                libs[str(self.path)] = self
             return
         if library.startswith("-l"):
             basename = library[2:]
@@ -152,8 +316,34 @@ class Library(pkg):
                             self.ldflags = [*Libs, *ld_flags, library]
                             self.abi = abi
                             self.link_mode = lm
+                            libs[str(self.path)] = self
                             return
 
+    def to_json(self):
+        return dict(
+            found=self.found,
+            name=self.name,
+            path=self.path and str(self.path),
+            ldflags=self.ldflags,
+            abi=self.abi and self.abi.name,
+            link_mode=dump_ls(self.link_mode),
+            link_mode_map=dump_ls_map(self.link_mode_map),
+        )
+
+    @classmethod
+    def from_json(cls, d):
+        self = cls.__new__(cls)
+        self.found = d["found"]
+        self.name = d["name"]
+        self.path = d["path"] and pathlib.Path(d["path"])
+        self.ldflags = d["ldflags"]
+        self.abi = d["abi"] and ABIS[d["abi"]]
+        self.link_mode = load_ls(d["link_mode"])
+        self.link_mode_map = load_ls_map(d["link_mode_map"])
+        if self.found and self.path:
+            libs[str(self.path)] = self
+        return self
+
     def ld_search(self, library, Libs, lm):
         print(f"{CXX} failed to resolve library, using {LD}")
         p = subprocess.run([LD, f"-{lm}", "--whole-archive", "-o", "/dev/null", "-t", library, *Libs], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
@@ -175,47 +365,167 @@ class Library(pkg):
         self._license_lookup = None
 
     def guess_license(self):
+        """
+        Start looking up the license in the background, returns the future
+        """
         if self.path is None:
             self.license = "(unused)"
-            return
-        with open(self.path, "rb") as f:
-            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return None
+        future = license_pool.submit(licenses_cache.lookup, self.path)
+        lookups.append(future)
+        self._license_lookup = future
+        future.add_done_callback(lambda f: setattr(self, "license", f.result()))
+        return future
+
+    @staticmethod
+    def get_abi(lib_path):
+        return abis.abi(lib_path)
+
+def find_license(path):
+    """
+    The SPDX identifier embedded in the library, or else what the platform's package manager says
+    """
+    with open(path, "rb") as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            mm = None
+        if mm is not None:
+            with mm:
                 idx = mm.find(b"SPDX-License-Identifier:")
                 if idx > -1:
-                    f.seek(idx)
-                    self.license = f.readline().decode('utf-8').split(":", 1)[1].strip()
-                    return
-        # No SPDX license information, fall back to async platform-specific checking
-        # We lack an event loop, so we'll just have to spawn of a worker thread :(
-        equery_exists = not subprocess.run(["which", "equery"], stdout=subprocess.PIPE, stderr=subprocess.PIPE).returncode
-        if equery_exists:
-            def equery():
-                pkg_owner = subprocess.run(["equery", "b", self.path], stdout=subprocess.PIPE)
-                if not pkg_owner.returncode:
-                    pkg_atom = re.split("-[0-9]", pkg_owner.stdout.decode('utf-8'))[0]
-                    meta = subprocess.run(["equery", "m", pkg_atom], stdout=subprocess.PIPE)
-                    if not meta.returncode:
-                        metadata = meta.stdout.decode('utf-8').splitlines()
-                        for line in metadata:
-                            if line.startswith('License:'):
-                                self.license = line.split("License:", 1)[1].strip()
-                                return
-                self.license = "Unknown"
-            self._license_lookup = threading.Thread(target=equery)
-            self._license_lookup.start()
+                    ends = [e for e in (mm.find(b"\n", idx), mm.find(b"\0", idx)) if e > -1]
+                    line = mm[idx:min(ends, default=len(mm))]
+                    return line.decode('utf-8', 'replace').split(":", 1)[1].strip()
+    if shutil.which("equery") is None:
+        print("Cannot determine license due to missing equery.")
+        return "unknown"
+    pkg_owner = subprocess.run(["equery", "b", path], stdout=subprocess.PIPE)
+    if not pkg_owner.returncode:
+        pkg_atom = re.split("-[0-9]", pkg_owner.stdout.decode('utf-8'))[0]
+        meta = subprocess.run(["equery", "m", pkg_atom], stdout=subprocess.PIPE)
+        if not meta.returncode:
+            metadata = meta.stdout.decode('utf-8').splitlines()
+            for line in metadata:
+                if line.startswith('License:'):
+                    return line.split("License:", 1)[1].strip()
+    return "Unknown"
+
+class LicenseCache(JsonCache):
+    """
+    Licenses of libraries, keyed on the library's digest
+    """
+    def lookup(self, path):
+        try:
+            key = digests.digest(path)
+            if key and (license := self.load().get(key)):
+                return license
+            license = find_license(path)
+        except OSError as e:
+            print("Cannot determine license of", path, e)
+            return "unknown"
+        # "unknown" means we had no way to look, so try again next time
+        if key and license != "unknown":
+            self[key] = license
+        return license
+
+licenses_cache = LicenseCache("licenses")
+
+def licenses():
+    """
+    Look up the license of every library found so far, all at once through a bounded pool.
+    Blocks until all are known, returns {library path: license}
+    """
+    futures = {}
+    found = {}
+    for path, lib in list(libs.items()):
+        if lib._license is not None:
+            found[path] = lib._license
         else:
-            print("Cannot determine license due to missing equery.")
-            self.license = "unknown"
+            futures[path] = lib._license_lookup or lib.guess_license()
+    for path, future in futures.items():
+        found[path] = future.result()
+    return dict(sorted(found.items()))
 
-    @staticmethod
-    def get_abi(lib_path):
-        with open(lib_path, 'rb') as lib:
-            data = lib.read()
-            if b'__11' in data:
-                return ABIS.libcxx
-            if b'__cxx11' in data:
-                return ABIS.libstdcpp
-        return ABIS.C
+def license_report(_=None):
+    """
+    Print a consolidated license report. Usable as the function of a target:
+    "licenses": {"virtual": True, "function": license_report}
+    """
+    report = licenses()
+    width = max(map(len, report), default=0)
+    for path, license in report.items():
+        print(f"{path:{width}}  {license}")
+    return True
+
+class PackageCache(JsonCache):
+    """
+    Packages found by Package.find_package, keyed on the query.
+    An entry is used as long as the .pc files of the package and of the packages
+    it requires, and every library it resolved to, keep their stat signature.
+    pkg-config cannot tell where the .pc files are, so with it only the libraries
+    are checked. Refresh with --refresh-packages.
+    """
+    version = 2
+    def __init__(self, name):
+        super().__init__(name)
+        # Keys of the entries looked up or stored this run
+        self.used = set()
+
+    def files(self):
+        """
+        The .pc and library files behind the packages used this run
+        """
+        for key in self.used:
+            for path, _ in self.get(key, {}).get("files", []):
+                yield path
+
+    def key(self, *query):
+        env = [os.environ.get(v) for v in ("PKG_CONFIG_PATH", "PKG_CONFIG_LIBDIR", "PKG_CONFIG_SYSROOT_DIR")]
+        return json.dumps([*query, CXX, LD, pkgconf, env], default=str)
+
+    def lookup(self, key):
+        if (entry := self.load().get(key)) is None:
+            return None
+        for path, sig in entry["files"]:
+            if stat_key(path) != sig:
+                return None
+        self.used.add(key)
+        return Package.from_json(entry["package"])
+
+    warned = False
+
+    def pc_files(self, name, pkgconf_flags):
+        """
+        The .pc files of name and of every package it requires, privately or not
+        """
+        if pkgconf == "pkg-config":
+            if not self.warned:
+                print("pkg-config has no --path, edits to .pc files go unnoticed until --refresh-packages")
+                PackageCache.warned = True
+            return []
+        run = lambda *args: subprocess.run([pkgconf, *args, *pkgconf_flags], stdout=subprocess.PIPE,
+                                           stderr=subprocess.PIPE).stdout.decode('utf-8').splitlines()
+        files = []
+        seen = set()
+        todo = [name]
+        while todo:
+            if (n := todo.pop()) in seen:
+                continue
+            seen.add(n)
+            files.extend(f.strip() for f in run(n, "--path") if f.strip())
+            for required in (*run(n, "--print-requires"), *run(n, "--print-requires-private")):
+                if required.split():
+                    todo.append(required.split()[0])
+        return files
+
+    def store(self, key, package, pkgconf_flags=()):
+        files = [str(lib.path) for lib in package.libs if lib.path]
+        files.extend(self.pc_files(package.name, pkgconf_flags))
+        self[key] = dict(files=[[f, stat_key(f)] for f in files], package=package.to_json())
+        self.used.add(key)
+
+packages = PackageCache("packages")
 
 class Package(pkg):
     found: bool
@@ -263,11 +573,45 @@ class Package(pkg):
         self.link_mode = link_mode
         self.link_mode_map = link_mode_map
 
+    def to_json(self):
+        return dict(
+            found=self.found,
+            name=self.name,
+            cflags=self.cflags,
+            ldflags=self.ldflags,
+            libs=[lib.to_json() for lib in self.libs],
+            link_mode=dump_ls(self.link_mode),
+            link_mode_map=dump_ls_map(self.link_mode_map),
+        )
+
+    @classmethod
+    def from_json(cls, d):
+        return cls(d["found"], d["name"], d["cflags"], d["ldflags"],
+                   [Library.from_json(lib) for lib in d["libs"]],
+                   load_ls(d["link_mode"]), load_ls_map(d["link_mode_map"]))
+
     @classmethod
     def find_package(cls, name, pkgconf_flags=(), abis=[ABIS.C, ABIS.libcxx], link_mode=shared, link_mode_map=None):
         """
         Find a package via pkgconf. If unsuccessful, returns a not-found package. This lets you use the package in branchless code
+        Found packages are cached in .pybuild/packages.json
         """
+        key = packages.key(name, list(pkgconf_flags), sorted(a.name for a in abis), dump_ls(link_mode), dump_ls_map(link_mode_map))
+        if (package := packages.lookup(key)) is not None:
+            return package
+        future = package_pool.submit(cls.resolve_and_store, key, name, pkgconf_flags, abis, link_mode, link_mode_map)
+        lookups.append(future)
+        return FuturePackage(future)
+
+    @classmethod
+    def resolve_and_store(cls, key, *query):
+        package = cls.resolve_package(*query)
+        if package.found:
+            packages.store(key, package, query[1])
+        return package
+
+    @classmethod
+    def resolve_package(cls, name, pkgconf_flags, abis, link_mode, link_mode_map):
         p = subprocess.run([pkgconf, name, "--exists", "--no-uninstalled", *pkgconf_flags], stdout=subprocess.PIPE)
         if p.returncode:
             print("pkgconf cannot find", name)
@@ -281,7 +625,7 @@ class Package(pkg):
             Libs = shlex.split(p.stdout.decode('utf-8'))
             p = subprocess.run([pkgconf, name, f"--{lm}", "--libs-only-other", "--keep-system-libs", "--no-uninstalled", *pkgconf_flags], stdout=subprocess.PIPE)
             ld_flags = shlex.split(p.stdout.decode('utf-8'))
-            libraries = [Library(lib, Libs, ld_flags, abis, link_mode, link_mode_map) for lib in libs]
+            libraries = list(library_pool.map(lambda lib: Library(lib, Libs, ld_flags, abis, link_mode, link_mode_map), libs))
             for lib in libraries:
                 if not lib.found:
                     break
@@ -290,6 +634,30 @@ class Package(pkg):
         print("pkgconf found", name, "but could not satisfy ABI or link-mode constraints")
         return cls(False, name, cflags=[], ldflags=[], libraries=[], link_mode=next(iter(link_mode)), link_mode_map={})
 
+class FuturePackage(pkg):
+    """
+    A Package that find_package is still resolving in the background.
+    Packages requested by targets.py resolve concurrently, and the first
+    call that needs the result waits for it. Attributes are forwarded.
+    """
+    def __init__(self, future):
+        self.future = future
+
+    def result(self):
+        return self.future.result()
+
+    def validate(self, mode):
+        return self.result().validate(mode)
+
+    def getCFlags(self, mode="debug"):
+        return self.result().getCFlags(mode)
+
+    def getLDFlags(self, mode="debug", link_mode=shared):
+        return self.result().getLDFlags(mode, link_mode)
+
+    def __getattr__(self, name):
+        return getattr(self.result(), name)
+
 def find_python(result = [], mode="debug"):
     if result:
         return result[0]
@@ -304,6 +672,6 @@ def find_python(result = [], mode="debug"):
     return r
 
 
-__all__ = ["find_python", "Package", "Library", "ABIS", "static", "shared"]
+__all__ = ["find_python", "Package", "FuturePackage", "Library", "ABIS", "static", "shared", "licenses", "license_report"]
 
 
@@ -0,0 +1,133 @@
+import os
+import json
+import subprocess
+import tempfile
+import pathlib
+from .cache import JsonCache, stat_key
+from .digest import digests
+
+class ScanCache(JsonCache):
+    """
+    Module dependencies of source files, keyed on the file's digest and the scan command.
+    Entries are [module_name, deps, system_headers, local_headers].
+    """
+    def key(self, path, args):
+        self.load()
+        if (d := digests.digest(path)) is None:
+            return None
+        return digests.hash(json.dumps([d, args]).encode('utf-8'))
+
+scans = ScanCache("scans")
+
+class ListingCache(JsonCache):
+    """
+    Directory listings keyed on the directory's stat signature.
+    Adding, removing or renaming an entry changes the directory's mtime,
+    so an unchanged directory is only stat'ed, never read.
+    """
+    def __init__(self, name):
+        super().__init__(name)
+        # Every directory listed this run
+        self.listed = set()
+
+    def listdir(self, path):
+        self.load()
+        key = os.path.abspath(path)
+        self.listed.add(key)
+        sig = stat_key(key)
+        if (entry := self.get(key)) and entry[0] == sig:
+            return entry[1], entry[2]
+        dirs, files = [], []
+        with os.scandir(key) as it:
+            for e in it:
+                (dirs if e.is_dir(follow_symlinks=False) else files).append(e.name)
+        dirs.sort()
+        files.sort()
+        self[key] = [sig, dirs, files]
+        return dirs, files
+
+    def modules(self, path):
+        """
+        What find_cppms reads of a directory: its subdirectories and .cppm files
+        """
+        dirs, files = self.listdir(path)
+        return dirs, [f for f in files if f.endswith(".cppm")]
+
+    def walk(self, top):
+        """
+        Like pathlib.Path.walk, top down without following symlinks
+        """
+        stack = [pathlib.Path(top)]
+        while stack:
+            p = stack.pop()
+            try:
+                dirs, files = self.listdir(p)
+            except OSError:
+                continue
+            yield p, dirs, files
+            stack.extend(p / d for d in reversed(dirs))
+
+listings = ListingCache("listings")
+
+def parse_p1689(text):
+    """
+    {primary-output: [module_name, deps, system_headers, local_headers]} for
+    every rule of P1689 json, {} if text is not json
+    """
+    try:
+        rules = json.loads(text).get("rules", [])
+    except ValueError:
+        return {}
+    results = {}
+    for rule in rules:
+        name = next((m["logical-name"] for m in rule.get("provides", [])), None)
+        deps, system, local = [], [], []
+        for r in rule.get("requires", []):
+            match r.get("lookup-method"):
+                case "include-angle":
+                    system.append(r["logical-name"])
+                case "include-quote":
+                    local.append(r["logical-name"])
+                case _:
+                    deps.append(r["logical-name"])
+        results[rule.get("primary-output")] = [name, deps, system, local]
+    return results
+
+def scan_p1689(files, tool="clang-scan-deps", jobs=os.cpu_count()):
+    """
+    Scan files, a mapping of paths to the command lines to scan them with, with a single
+    `clang-scan-deps -format=p1689` over a temporary compilation database.
+    Returns {abspath: [module_name, deps, system_headers, local_headers]} for every file
+    that could be scanned. Only files missing from the cache are passed to the tool.
+    """
+    scans.load()
+    results = {}
+    todo = {}
+    for p, args in files.items():
+        p = os.path.abspath(p)
+        if (k := scans.key(p, args)) is None:
+            continue
+        if k in scans:
+            results[p] = scans[k]
+        else:
+            todo[p] = k, args
+    if not todo:
+        return results
+    with tempfile.TemporaryDirectory(prefix="pybuild-") as tmp:
+        outputs = {}
+        db = []
+        for i, (p, (_, args)) in enumerate(todo.items()):
+            out = f"{tmp}/{i}.o"
+            outputs[out] = p
+            db.append(dict(directory=os.getcwd(), file=p, output=out, arguments=[*args, "-c", p, "-o", out]))
+        with open(f"{tmp}/compile_commands.json", "w", encoding="utf-8") as f:
+            json.dump(db, f)
+        proc = subprocess.run([tool, "-format=p1689", f"-compilation-database={tmp}/compile_commands.json", f"-j={jobs}"],
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if proc.returncode:
+        print(tool, "failed, some files will be scanned by pybuild:")
+        print(proc.stderr.decode('utf-8'))
+    for out, r in parse_p1689(proc.stdout).items():
+        if (p := outputs.get(out)) is not None:
+            results[p] = scans[todo[p][0]] = r
+    return results
@@ -0,0 +1,89 @@
+import json
+import sqlite3
+import pathlib
+
+
+class StatusTable(dict):
+    """
+    One table of the status store for a single build dir and mode.
+    Reads are served from memory; every write goes straight to the database,
+    so a crash or Ctrl-C keeps everything recorded up to that point.
+    """
+    def __init__(self, store, table, build, mode):
+        super().__init__()
+        self.store = store
+        self.where = (table, build, mode)
+        for name, value in store.db.execute(
+                "SELECT name, value FROM status WHERE tbl = ? AND build = ? AND mode = ?", self.where):
+            super().__setitem__(name, json.loads(value))
+
+    def __setitem__(self, name, value):
+        super().__setitem__(name, value)
+        self.store.db.execute("INSERT OR REPLACE INTO status VALUES (?, ?, ?, ?, ?)",
+                              (*self.where, name, json.dumps(value)))
+
+    def __delitem__(self, name):
+        super().__delitem__(name)
+        self.store.db.execute("DELETE FROM status WHERE tbl = ? AND build = ? AND mode = ? AND name = ?",
+                              (*self.where, name))
+
+    def pop(self, name, *default):
+        if name in self:
+            value = self[name]
+            del self[name]
+            return value
+        return super().pop(name, *default)
+
+    def clear(self):
+        super().clear()
+        self.store.db.execute("DELETE FROM status WHERE tbl = ? AND build = ? AND mode = ?", self.where)
+
+
+class StatusStore:
+    """
+    The persistent build state, in sqlite.
+    Rows are keyed on (table, build dir, mode, name); only the tables of the
+    build dir and mode in use are ever loaded.
+    """
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS status (
+            tbl TEXT, build TEXT, mode TEXT, name TEXT, value TEXT,
+            PRIMARY KEY (tbl, build, mode, name))""")
+
+    def table(self, table, build, mode):
+        return StatusTable(self, table, str(build), mode)
+
+    def migrate(self, json_path):
+        """
+        Import a status.json written by older versions, then move it out of the way
+        """
+        json_path = pathlib.Path(json_path)
+        if not json_path.exists():
+            return
+        with json_path.open("r", encoding="utf-8") as f:
+            meta_status = json.load(f)
+        rows = []
+        for build, modes in meta_status.items():
+            if build in ("timings", "discovered", "hash_algorithm"):
+                continue
+            for mode, states in modes.items():
+                rows.extend(("status", build, mode, name, json.dumps(sha)) for name, sha in states.items())
+        for table in ("timings", "discovered"):
+            for build, modes in meta_status.get(table, {}).items():
+                for mode, entries in modes.items():
+                    rows.extend((table, build, mode, name, json.dumps(v)) for name, v in entries.items())
+        for build, modes in meta_status.get("hash_algorithm", {}).items():
+            for mode, algorithm in modes.items():
+                rows.append(("settings", build, mode, "hash_algorithm", json.dumps(algorithm)))
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.executemany("INSERT OR REPLACE INTO status VALUES (?, ?, ?, ?, ?)", rows)
+        json_path.rename(json_path.with_name(json_path.name + ".migrated"))
+        print(f"Migrated {json_path} to {self.path}")
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,153 @@
+import os
+import time
+import errno
+import struct
+import ctypes
+import selectors
+from .cache import stat_key
+
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_ONLYDIR = 0x1000000
+
+EVENTS = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+ENTRY_EVENTS = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+event = struct.Struct("iIII")
+
+
+def inotify_init():
+    """
+    An inotify fd, or None where inotify is unavailable
+    """
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None, None
+    if fd < 0:
+        return None, None
+    return libc, fd
+
+
+class Watcher:
+    """
+    Reports changes to a set of files, and to the entries of a set of directories.
+    Uses inotify on their directories if possible, otherwise polls their stat signatures.
+    Changes are reported as the absolute paths of the watched files and directories.
+    """
+    settle = 0.1
+    poll_interval = 0.5
+    def __init__(self, files, dirs=()):
+        self.files = set()
+        self.dirs = set()
+        self.watches = {}
+        self.signatures = {}
+        self.polled = time.monotonic()
+        self.libc, self.fd = inotify_init()
+        self.add(files, dirs)
+
+    def add(self, files, dirs=()):
+        """
+        Watch more files and directories, such as inputs a depfile listed
+        """
+        files = {os.path.abspath(f) for f in files} - self.files
+        dirs = {os.path.abspath(d) for d in dirs} - self.dirs
+        self.files |= files
+        self.dirs |= dirs
+        if self.fd is not None:
+            watched = set(self.watches.values())
+            for d in {os.path.dirname(f) for f in files} | dirs:
+                if d in watched:
+                    continue
+                wd = self.libc.inotify_add_watch(self.fd, os.fsencode(d), EVENTS | IN_ONLYDIR)
+                if wd < 0 and (err := ctypes.get_errno()) != errno.ENOENT:
+                    print(f"inotify unavailable: {os.strerror(err)}, polling for changes")
+                    os.close(self.fd)
+                    self.fd = None
+                    files, dirs = self.files, self.dirs
+                    break
+                if wd >= 0:
+                    self.watches[wd] = d
+        if self.fd is None:
+            self.signatures.update({p: stat_key(p) for p in files | dirs})
+
+    def fileno(self):
+        return self.fd
+
+    def changes(self):
+        """
+        The watched paths that changed since the last call, without blocking.
+        Without inotify, they are polled at most every poll_interval seconds.
+        """
+        if self.fd is None:
+            if time.monotonic() - self.polled < self.poll_interval:
+                return set()
+            return self.poll()
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, 1 << 16)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = event.unpack_from(data, offset)
+                offset += event.size
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    changed.update(self.files | self.dirs)
+                    continue
+                if (d := self.watches.get(wd)) is None:
+                    continue
+                path = os.path.join(d, os.fsdecode(name))
+                if path in self.files:
+                    changed.add(path)
+                if d in self.dirs and mask & ENTRY_EVENTS:
+                    changed.add(d)
+
+    def poll(self):
+        self.polled = time.monotonic()
+        changed = set()
+        for p, sig in self.signatures.items():
+            if (now := stat_key(p)) != sig:
+                self.signatures[p] = now
+                changed.add(p)
+        return changed
+
+    def wait(self, timeout=None):
+        """
+        Block until something changed, then keep collecting changes until none
+        came in for settle seconds, so a burst of writes is reported at once.
+        Returns an empty set once timeout seconds pass without a change.
+        """
+        with selectors.DefaultSelector() as sel:
+            if self.fd is not None:
+                sel.register(self.fd, selectors.EVENT_READ)
+            changed = set()
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while True:
+                interval = self.settle if changed else self.poll_interval
+                if deadline is not None:
+                    interval = max(0, min(interval, deadline - time.monotonic()))
+                if self.fd is not None:
+                    sel.select(interval)
+                    new = self.changes()
+                else:
+                    time.sleep(interval)
+                    new = self.poll()
+                if new:
+                    changed |= new
+                elif changed or (deadline is not None and time.monotonic() >= deadline):
+                    return changed
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
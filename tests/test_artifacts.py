@@ -0,0 +1,38 @@
+import os
+import sys
+import pathlib
+import subprocess
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+TARGETS = """
+from pybuild import target
+targets = {
+    "all": {"virtual": True, "deps": ["b.out"]},
+    "a.out": target(source=["a.src"], args=["sh", "-c", "cat a.src > a.out"]),
+    "b.out": target(deps=["a.out"], args=["sh", "-c", "cat a.out > b.out"]),
+}
+"""
+
+
+def build(path):
+    env = dict(os.environ, PYTHONPATH=str(ROOT), PYBUILD_CACHE=str(path / ".pybuild"))
+    subprocess.run([sys.executable, "-m", "pybuild", "--artifact-cache", str(path / "artifacts")],
+                   cwd=path, env=env, check=True, stdout=subprocess.DEVNULL)
+
+
+def test_dependency_change_misses(tmp_path):
+    (tmp_path / "targets.py").write_text(TARGETS)
+    src = tmp_path / "a.src"
+    src.write_text("one\n")
+    build(tmp_path)
+    src.write_text("two\n")
+    build(tmp_path)
+    assert (tmp_path / "b.out").read_text() == "two\n"
+    # Back to a state that was cached, then forward again: both must restore what was built for them
+    src.write_text("one\n")
+    build(tmp_path)
+    assert (tmp_path / "b.out").read_text() == "one\n"
+    src.write_text("two\n")
+    build(tmp_path)
+    assert (tmp_path / "b.out").read_text() == "two\n"
@@ -0,0 +1,16 @@
+from pybuild.build import parse_depfile
+
+
+def test_parse_depfile(tmp_path):
+    depfile = tmp_path / "a.o.d"
+    depfile.write_text(
+        "a.o: a.cpp include/foo\\ bar.h \\\n"
+        "  gen/$$x.h a.cpp\n"
+        "include/foo\\ bar.h:\n")
+    assert parse_depfile(depfile) == ["a.cpp", "include/foo bar.h", "gen/$x.h"]
+
+
+def test_parse_depfile_escaped_hash_and_crlf(tmp_path):
+    depfile = tmp_path / "b.o.d"
+    depfile.write_bytes(b"b.o: b.cpp \\\r\n  odd\\#name.h\r\n")
+    assert parse_depfile(depfile) == ["b.cpp", "odd#name.h"]
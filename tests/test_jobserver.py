@@ -0,0 +1,39 @@
+import os
+from pybuild.jobserver import Jobserver
+
+
+def test_pipe_auth():
+    r, w = os.pipe()
+    try:
+        js = Jobserver.from_makeflags(f"-j4 --jobserver-auth={r},{w}")
+        assert js.jobs == 4
+        assert js.auth == f"{r},{w}"
+        assert js.pass_fds == (r, w)
+        js.close()
+        os.fstat(r)
+    finally:
+        os.close(r)
+        os.close(w)
+
+
+def test_fifo_auth(tmp_path):
+    fifo = tmp_path / "fifo"
+    os.mkfifo(fifo)
+    js = Jobserver.from_makeflags(f" -j2 --jobserver-auth=fifo:{fifo}")
+    assert js.auth == f"fifo:{fifo}"
+    assert js.jobs == 2
+    js.close()
+
+
+def test_auth_overrides_makeflags(tmp_path):
+    fifo = tmp_path / "fifo"
+    os.mkfifo(fifo)
+    js = Jobserver.from_makeflags("--jobserver-fds=7,8", auth=f"fifo:{fifo}")
+    assert js.auth == f"fifo:{fifo}"
+    js.close()
+
+
+def test_no_jobserver():
+    assert Jobserver.from_makeflags("") is None
+    assert Jobserver.from_makeflags("-j8 -k") is None
+    assert Jobserver.from_makeflags("--jobserver-auth=-1,-1") is None
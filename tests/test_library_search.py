@@ -0,0 +1,51 @@
+import struct
+from pybuild.library_search import ABIS, AbiCache, symbol_names
+
+LIBSTDCPP = b"\0_ZNKSt7__cxx1112basic_stringIcSt11char_traitsIcESaIcEE4sizeEv\0"
+
+
+def elf(strtab):
+    """
+    A little endian ELF64 file with a null section and one string table
+    """
+    shoff = 64 + len(strtab)
+    header = b"\x7fELF" + bytes([2, 1, 1]) + bytes(9)
+    header += struct.pack("<HHIQQQIHHHHHH", 1, 62, 1, 0, 0, shoff, 0, 64, 0, 0, 64, 2, 1)
+    null = bytes(64)
+    table = struct.pack("<IIQQQQIIQQ", 0, 3, 0, 0, 64, len(strtab), 0, 0, 1, 0)
+    return header + strtab + null + table
+
+
+def member(name, data):
+    header = f"{name:<16}{0:<12}{0:<6}{0:<6}{644:<8}{len(data):<10}`\n".encode()
+    return header + data + b"\n" * (len(data) & 1)
+
+
+def archive(*members):
+    return b"!<arch>\n" + b"".join(member(n, d) for n, d in members)
+
+
+def test_elf_string_tables():
+    tables = symbol_names(elf(LIBSTDCPP))
+    assert [bytes(t) for t in tables] == [LIBSTDCPP]
+
+
+def test_archive_members_are_scanned(tmp_path):
+    # The armap only names what the archive defines, none of it mangled
+    armap = struct.pack(">I", 1) + struct.pack(">I", 0) + b"plain_c_function\0"
+    lib = tmp_path / "libmixed.a"
+    lib.write_bytes(archive(("/", armap), ("a.o/", elf(b"\0plain_c_function\0")), ("b.o/", elf(LIBSTDCPP))))
+    tables = symbol_names(lib.read_bytes())
+    assert len(tables) == 2
+    assert AbiCache.scan(lib) is ABIS.libstdcpp
+
+
+def test_thin_archive_uses_armap(tmp_path):
+    armap = struct.pack(">I", 1) + struct.pack(">I", 0) + b"plain_c_function\0"
+    data = b"!<thin>\n" + member("/", armap) + f"{'a.o/':<16}{0:<12}{0:<6}{0:<6}{644:<8}{1234:<10}`\n".encode()
+    tables = symbol_names(data)
+    assert [bytes(t) for t in tables] == [armap]
+
+
+def test_not_a_library():
+    assert symbol_names(b"#!/bin/sh\n" + bytes(100)) is None
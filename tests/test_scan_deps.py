@@ -0,0 +1,24 @@
+import json
+from pybuild.scan_deps import parse_p1689
+
+
+def test_parse_p1689():
+    text = json.dumps({"version": 1, "revision": 0, "rules": [
+        {"primary-output": "0.o",
+         "provides": [{"logical-name": "app", "is-interface": True}],
+         "requires": [
+             {"logical-name": "lib"},
+             {"logical-name": "vector", "lookup-method": "include-angle"},
+             {"logical-name": "local.h", "lookup-method": "include-quote"},
+         ]},
+        {"primary-output": "1.o"},
+    ]})
+    assert parse_p1689(text) == {
+        "0.o": ["app", ["lib"], ["vector"], ["local.h"]],
+        "1.o": [None, [], [], []],
+    }
+
+
+def test_parse_p1689_not_json():
+    assert parse_p1689(b"") == {}
+    assert parse_p1689(b"clang-scan-deps: error") == {}
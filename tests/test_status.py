@@ -0,0 +1,63 @@
+import os
+import sys
+import json
+import time
+import signal
+import pathlib
+import subprocess
+from pybuild.status import StatusStore
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+TARGETS = """
+from pybuild import target
+targets = {
+    "all": {"virtual": True, "deps": ["d.out"]},
+    "a.out": target(source=["a.src"], args=["sh", "-c", "cat a.src > a.out"]),
+    "d.out": target(deps=["a.out"], args=["sh", "-c", "sleep 2; cat a.out > d.out"]),
+}
+"""
+
+
+def pybuild(path, **kw):
+    env = dict(os.environ, PYTHONPATH=str(ROOT), PYBUILD_CACHE=str(path / ".pybuild"))
+    return subprocess.Popen([sys.executable, "-m", "pybuild"], cwd=path, env=env,
+                            stdout=subprocess.DEVNULL, **kw)
+
+
+def test_killed_between_dependency_and_dependent(tmp_path):
+    (tmp_path / "targets.py").write_text(TARGETS)
+    src = tmp_path / "a.src"
+    src.write_text("one\n")
+    assert pybuild(tmp_path).wait() == 0
+    src.write_text("two\n")
+    p = pybuild(tmp_path, start_new_session=True)
+    deadline = time.monotonic() + 10
+    while (tmp_path / "a.out").read_text() != "two\n" and time.monotonic() < deadline:
+        time.sleep(0.05)
+    time.sleep(0.2)
+    os.killpg(p.pid, signal.SIGKILL)
+    p.wait()
+    assert (tmp_path / "d.out").read_text() == "one\n"
+    assert pybuild(tmp_path).wait() == 0
+    assert (tmp_path / "d.out").read_text() == "two\n"
+
+
+def test_migrate(tmp_path):
+    old = tmp_path / "status.json"
+    old.write_text(json.dumps({
+        "build/debug": {"debug": {"a.o": "abc"}},
+        "timings": {"build/debug": {"debug": {"a.o": 1.5}}},
+        "discovered": {"build/debug": {"debug": {"a.o": ["a.h"]}}},
+        "hash_algorithm": {"build/debug": {"debug": "sha256"}},
+    }))
+    store = StatusStore(tmp_path / "status.db")
+    store.migrate(old)
+    assert not old.exists()
+    assert (tmp_path / "status.json.migrated").exists()
+    assert store.table("status", "build/debug", "debug") == {"a.o": "abc"}
+    assert store.table("timings", "build/debug", "debug") == {"a.o": 1.5}
+    assert store.table("discovered", "build/debug", "debug") == {"a.o": ["a.h"]}
+    assert store.table("settings", "build/debug", "debug") == {"hash_algorithm": "sha256"}
+    assert store.table("status", "build/debug", "release") == {}
+    store.close()